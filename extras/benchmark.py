@@ -0,0 +1,386 @@
+# coding=utf-8
+"""
+Benchmarks the plugin's device I/O against fake Wemo devices on loopback.
+
+Starts ``--plugs`` stand-in devices from ``fake_wemo.py`` for every plug
+count given, drives the plugin against them and writes p50/p95/p99
+latency, throughput and thread counts per scenario as JSON::
+
+    python extras/benchmark.py --plugs 1,10,50,200 --output before.json
+    python extras/benchmark.py --plugs 1,10,50,200 --output after.json --compare before.json
+
+Needs OctoPrint and pywemo installed in the same environment, the plugin is
+imported from this checkout. With ``--compare`` the run is checked against
+an earlier baseline and the exit code is 1 if any scenario got slower than
+``--threshold`` percent.
+
+The ``subscription_push`` scenario runs with event subscriptions on and
+polling off, and flips the fake relays so the devices send GENA NOTIFY
+callbacks. The exit code is also 1 if any of those state changes never
+reaches the plugin.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import octoprint_wemoswitch  # noqa: E402
+from fake_wemo import FakeWemoDevice  # noqa: E402
+
+PLUG_DEFAULTS = {'ip': '', 'label': '', 'icon': 'icon-bolt', 'displayWarning': True, 'warnPrinting': False,
+				 'thermal_runaway': False, 'gcodeEnabled': False, 'gcodeOnDelay': 0, 'gcodeOffDelay': 0,
+				 'autoConnect': False, 'autoConnectDelay': 10.0, 'autoDisconnect': False, 'autoDisconnectDelay': 0,
+				 'sysCmdOn': False, 'sysRunCmdOn': '', 'sysCmdOnDelay': 0, 'sysCmdOff': False, 'sysRunCmdOff': '',
+				 'sysCmdOffDelay': 0, 'currentState': 'unknown', 'btnColor': '#808080',
+				 'automaticShutdownEnabled': True, 'event_on_startup': False, 'event_on_upload': False}
+
+# how long a pushed state change may take to show up before it counts as lost
+SUBSCRIPTION_TIMEOUT = 5.0
+
+GCODE_LINES = ["G1 X10 Y10 E0.5", "M105", "G1 X20 Y10 E0.5", "M104 S200", "G28", "M106 S255"]
+
+# OctoPrint has all of these loaded before plugins are, so only the plugin's own imports are timed
+IMPORT_SNIPPET = """
+import sys, time
+sys.path.insert(0, %r)
+import flask, flask_babel, octoprint.plugin, octoprint.util, octoprint.util.version, octoprint.events, octoprint.access.permissions
+start = time.time()
+import octoprint_wemoswitch
+print("%%r %%d" %% (time.time() - start, "pywemo" in sys.modules))
+"""
+
+
+class BenchmarkSettings(object):
+	"""Just enough of OctoPrint's settings to run the plugin outside OctoPrint."""
+
+	def __init__(self, data):
+		self._data = data
+
+	def get(self, path, **kwargs):
+		return copy.deepcopy(self._data.get(path[0]))
+
+	def get_int(self, path, **kwargs):
+		value = self._data.get(path[0])
+		return None if value is None else int(value)
+
+	def get_float(self, path, **kwargs):
+		value = self._data.get(path[0])
+		return None if value is None else float(value)
+
+	def get_boolean(self, path, **kwargs):
+		return bool(self._data.get(path[0]))
+
+	def set(self, path, value, **kwargs):
+		self._data[path[0]] = value
+
+	def set_boolean(self, path, value, **kwargs):
+		self._data[path[0]] = bool(value)
+
+	def save(self, **kwargs):
+		pass
+
+
+class BenchmarkPrinter(object):
+	def connect(self, *args, **kwargs):
+		pass
+
+	def disconnect(self, *args, **kwargs):
+		pass
+
+	def is_ready(self):
+		return False
+
+	def is_printing(self):
+		return False
+
+	def is_operational(self):
+		return False
+
+	def is_closed_or_error(self):
+		return True
+
+	def get_current_temperatures(self):
+		return {}
+
+
+class BenchmarkPluginManager(object):
+	def __init__(self):
+		self.messages = 0
+
+	def send_plugin_message(self, identifier, data):
+		self.messages += 1
+
+
+class ThreadSampler(threading.Thread):
+	"""Records the highest number of live threads while a scenario runs."""
+
+	def __init__(self, interval=0.01):
+		threading.Thread.__init__(self, name="Benchmark ThreadSampler")
+		self.daemon = True
+		self.interval = interval
+		self.peak = threading.active_count()
+		self._stopped = threading.Event()
+
+	def run(self):
+		while not self._stopped.wait(self.interval):
+			self.peak = max(self.peak, threading.active_count())
+
+	def stop(self):
+		self._stopped.set()
+		self.join()
+		return self.peak
+
+
+def percentile(values, pct):
+	if not values:
+		return None
+	values = sorted(values)
+	index = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+	return values[min(index, len(values) - 1)]
+
+
+def summarize(latencies, errors, wall):
+	calls = len(latencies)
+	return dict(calls=calls,
+				errors=errors,
+				p50=percentile(latencies, 50),
+				p95=percentile(latencies, 95),
+				p99=percentile(latencies, 99),
+				mean=sum(latencies) / calls if calls else None,
+				max=max(latencies) if latencies else None,
+				throughput=calls / wall if wall else None)
+
+
+def make_plugin(plugips, **overrides):
+	plugin = octoprint_wemoswitch.wemoswitchPlugin()
+	plugin._identifier = "wemoswitch"
+	data = plugin.get_settings_defaults()
+	data.update(overrides)
+	data["arrSmartplugs"] = [dict(PLUG_DEFAULTS, ip=plugip) for plugip in plugips]
+	plugin._settings = BenchmarkSettings(data)
+	plugin._printer = BenchmarkPrinter()
+	plugin._plugin_manager = BenchmarkPluginManager()
+	plugin._plugin_version = "benchmark"
+	plugin._config = octoprint_wemoswitch.WemoConfig.from_settings(plugin._settings)
+	plugin._build_plug_registry()
+	plugin._scheduler.start()
+	return plugin
+
+
+def run_scenario(plugips, iterations, call, failed):
+	"""Calls ``call(plugip)`` for every plug, ``iterations`` times, one after the other."""
+	latencies = []
+	errors = 0
+	sampler = ThreadSampler()
+	sampler.start()
+	start = time.time()
+	for _ in range(iterations):
+		for plugip in plugips:
+			t = time.time()
+			result = call(plugip)
+			latencies.append(time.time() - t)
+			if failed(result):
+				errors += 1
+	wall = time.time() - start
+	summary = summarize(latencies, errors, wall)
+	summary["threads_peak"] = sampler.stop()
+	summary["threads_after"] = threading.active_count()
+	return summary
+
+
+def run_shutdown(plugin, iterations):
+	latencies = []
+	sampler = ThreadSampler()
+	sampler.start()
+	start = time.time()
+	for _ in range(iterations):
+		t = time.time()
+		plugin._shutdown_system()
+		latencies.append(time.time() - t)
+	wall = time.time() - start
+	summary = summarize(latencies, 0, wall)
+	summary["threads_peak"] = sampler.stop()
+	summary["threads_after"] = threading.active_count()
+	return summary
+
+
+def run_subscriptions(devices, iterations):
+	"""
+	Flips the relay of every device and times how long the NOTIFY takes to
+	update the plugin's plug state. Polling stays off, so a state change that
+	doesn't arrive counts as an error.
+	"""
+	plugips = [device.address for device in devices]
+	plugin = make_plugin(plugips, subscriptionsEnabled=True, pollingEnabled=False)
+	try:
+		plugin._start_subscriptions()
+		deadline = time.time() + SUBSCRIPTION_TIMEOUT
+		while not all(plugin._is_subscribed(plugip) for plugip in plugips) and time.time() < deadline:
+			time.sleep(0.01)
+
+		def flip(device):
+			state = 0 if device.state else 1
+			device.set_state(state)
+			expected = "on" if state else "off"
+			deadline = time.time() + SUBSCRIPTION_TIMEOUT
+			while plugin._plug_states.get(device.address) != expected:
+				if time.time() > deadline:
+					return False
+				time.sleep(0.001)
+			return True
+
+		return run_scenario(devices, iterations, flip, lambda result: not result)
+	finally:
+		plugin.on_shutdown()
+
+
+def run_gcode_hook(plugin, lines):
+	plugin._config = plugin._config._replace(powerOffWhenIdle=True, idleIgnoreCommands=frozenset(["M105"]))
+	parsed = [(line, line.split()[0]) for line in GCODE_LINES]
+	start = time.time()
+	for i in range(lines):
+		cmd, gcode = parsed[i % len(parsed)]
+		plugin.processGCODE(None, "queuing", cmd, None, gcode)
+	wall = time.time() - start
+	return dict(calls=lines, per_line_us=wall / lines * 1e6, throughput=lines / wall if wall else None)
+
+
+def benchmark(count, args):
+	devices = [FakeWemoDevice(name="Bench %d" % i, latency=args.latency, jitter=args.jitter,
+							  failure_rate=args.failure_rate).start() for i in range(count)]
+	plugips = [device.address for device in devices]
+	plugin = make_plugin(plugips)
+	results = {}
+	try:
+		# the first pass pays for probing and setup.xml, everything after hits the device cache
+		results["resolve"] = run_scenario(plugips, 1, lambda plugip: plugin.sendCommand("info", plugip),
+										  lambda result: result not in (0, 1, 8))
+		results["send_command"] = run_scenario(plugips, args.iterations, lambda plugip: plugin.sendCommand("info", plugip),
+											   lambda result: result not in (0, 1, 8))
+		results["check_status"] = run_scenario(plugips, args.iterations, plugin.check_status,
+											   lambda result: False)
+		results["turn_on"] = run_scenario(plugips, args.iterations, plugin.turn_on,
+										  lambda result: result != "on")
+		# turn_off only starts the power off sequence, time it until it completed
+		results["turn_off"] = run_scenario(plugips, args.iterations, plugin._turn_off_and_wait,
+										   lambda result: result is None or result["status"] != "done")
+		results["shutdown_system"] = run_shutdown(plugin, args.iterations)
+		results["gcode_hook"] = run_gcode_hook(plugin, args.gcode_lines)
+		results["subscription_push"] = run_subscriptions(devices, args.iterations)
+	finally:
+		plugin.on_shutdown()
+		for device in devices:
+			device.stop()
+	return results
+
+
+def measure_import(runs):
+	"""Times ``import octoprint_wemoswitch`` in fresh interpreters."""
+	snippet = IMPORT_SNIPPET % os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	timings = []
+	pywemo_loaded = False
+	for _ in range(runs):
+		output = subprocess.check_output([sys.executable, "-c", snippet]).decode("utf-8").split()
+		timings.append(float(output[0]))
+		pywemo_loaded = output[1] == "1"
+	return dict(runs=runs, p50=percentile(timings, 50), min=min(timings), max=max(timings), pywemo_loaded=pywemo_loaded)
+
+
+def compare(baseline, current, threshold):
+	"""Prints the change of every latency percentile, returns the list of regressions."""
+	regressions = []
+	before, after = baseline.get("import"), current.get("import")
+	if before and after and before.get("p50") and after.get("p50"):
+		change = (after["p50"] - before["p50"]) / before["p50"] * 100
+		flag = ""
+		if change > threshold:
+			flag = "  REGRESSION"
+			regressions.append(("import", "import", "p50", change))
+		print("%-27s %-11s %12.6f -> %12.6f  %+7.1f%%%s" % ("plugin import", "p50", before["p50"], after["p50"], change, flag))
+	for count, scenarios in sorted(current["results"].items(), key=lambda item: int(item[0])):
+		for scenario, summary in sorted(scenarios.items()):
+			before = baseline.get("results", {}).get(count, {}).get(scenario)
+			if before is None:
+				continue
+			for key in ("p50", "p95", "p99", "per_line_us"):
+				if before.get(key) is None or summary.get(key) is None:
+					continue
+				change = (summary[key] - before[key]) / before[key] * 100 if before[key] else 0
+				flag = ""
+				if change > threshold:
+					flag = "  REGRESSION"
+					regressions.append((count, scenario, key, change))
+				print("%4s plugs %-16s %-11s %12.6f -> %12.6f  %+7.1f%%%s" % (count, scenario, key, before[key], summary[key], change, flag))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the plugin against fake Wemo devices.")
+	parser.add_argument("--plugs", default="1,10,50", help="comma separated plug counts to run, 1 to 200")
+	parser.add_argument("--iterations", type=int, default=5, help="passes over all plugs per scenario")
+	parser.add_argument("--latency", type=float, default=0, help="seconds every fake device request takes")
+	parser.add_argument("--jitter", type=float, default=0, help="up to this many extra seconds per request")
+	parser.add_argument("--failure-rate", type=float, default=0, help="fraction of requests the devices drop")
+	parser.add_argument("--gcode-lines", type=int, default=100000, help="lines to push through the gcode hook")
+	parser.add_argument("--import-runs", type=int, default=5, help="fresh interpreters to time the plugin import in")
+	parser.add_argument("--output", help="write the results to this file instead of stdout")
+	parser.add_argument("--compare", help="baseline JSON file to compare the results against")
+	parser.add_argument("--threshold", type=float, default=10, help="percent slowdown counted as a regression")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.ERROR)
+
+	counts = [int(count) for count in args.plugs.split(",")]
+	for count in counts:
+		if not 1 <= count <= 200:
+			parser.error("plug counts must be between 1 and 200")
+
+	import pywemo
+	report = dict(meta=dict(python=platform.python_version(),
+							pywemo=getattr(pywemo, "__version__", None),
+							platform=platform.platform(),
+							timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+							iterations=args.iterations,
+							latency=args.latency,
+							jitter=args.jitter,
+							failure_rate=args.failure_rate),
+				  results={})
+	print("Timing plugin import...", file=sys.stderr)
+	report["import"] = measure_import(args.import_runs)
+	for count in counts:
+		print("Benchmarking %s plugs..." % count, file=sys.stderr)
+		report["results"][str(count)] = benchmark(count, args)
+
+	lost = sum(results["subscription_push"]["errors"] for results in report["results"].values())
+	if lost:
+		print("%s state changes pushed by the devices never reached the plugin." % lost, file=sys.stderr)
+
+	output = json.dumps(report, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(output)
+	else:
+		print(output)
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		if compare(baseline, report, args.threshold):
+			sys.exit(1)
+	if lost:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
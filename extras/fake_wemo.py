@@ -0,0 +1,367 @@
+# coding=utf-8
+"""
+Local stand-in for Belkin Wemo devices.
+
+Serves ``setup.xml``, the basicevent/insight service descriptions and their
+SOAP actions on loopback, and sends GENA NOTIFY callbacks to subscribers
+whenever the relay state changes. Run it directly to get a handful of
+plugs to point the plugin at::
+
+    python extras/fake_wemo.py --count 3
+
+Every device listens on its own port on 127.0.0.1, so configure plugs as
+``127.0.0.1:<port>``. ``--latency``, ``--jitter`` and ``--failure-rate``
+make the devices slow or flaky, see also ``extras/benchmark.py``.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from http.client import HTTPConnection
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from httplib import HTTPConnection
+
+SETUP_XML = """<?xml version="1.0"?>
+<root xmlns="urn:Belkin:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:Belkin:device:{device_type}:1</deviceType>
+    <friendlyName>{name}</friendlyName>
+    <manufacturer>Belkin International Inc.</manufacturer>
+    <manufacturerURL>http://www.belkin.com</manufacturerURL>
+    <modelDescription>Belkin Plugin Socket 1.0</modelDescription>
+    <modelName>{model}</modelName>
+    <modelNumber>1.0</modelNumber>
+    <modelURL>http://www.belkin.com/plugin/</modelURL>
+    <serialNumber>{serial}</serialNumber>
+    <UDN>uuid:{model}-1_0-{serial}</UDN>
+    <macAddress>{mac}</macAddress>
+    <firmwareVersion>WeMo_WW_2.00.11532.PVT-OWRT-SNS</firmwareVersion>
+    <binaryState>{state}</binaryState>
+    <serviceList>
+{services}
+    </serviceList>
+    <presentationURL>/pluginpres.html</presentationURL>
+  </device>
+</root>"""
+
+SERVICE_XML = """      <service>
+        <serviceType>urn:Belkin:service:{name}:1</serviceType>
+        <serviceId>urn:Belkin:serviceId:{name}1</serviceId>
+        <controlURL>/upnp/control/{name}1</controlURL>
+        <eventSubURL>/upnp/event/{name}1</eventSubURL>
+        <SCPDURL>/{name}service.xml</SCPDURL>
+      </service>"""
+
+SCPD_XML = """<?xml version="1.0"?>
+<scpd xmlns="urn:Belkin:service-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <actionList>
+{actions}
+  </actionList>
+  <serviceStateTable>
+    <stateVariable sendEvents="yes"><name>BinaryState</name><dataType>Boolean</dataType><defaultValue>0</defaultValue></stateVariable>
+  </serviceStateTable>
+</scpd>"""
+
+ACTION_XML = """    <action>
+      <name>{name}</name>
+      <argumentList>
+        <argument><retval/><name>{argument}</name><relatedStateVariable>BinaryState</relatedStateVariable><direction>{direction}</direction></argument>
+      </argumentList>
+    </action>"""
+
+SERVICE_ACTIONS = {
+	"basicevent": [("GetBinaryState", "BinaryState", "out"),
+				   ("SetBinaryState", "BinaryState", "in")],
+	"insight": [("GetInsightParams", "InsightParams", "out")],
+}
+
+SOAP_RESPONSE = """<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body>
+<u:{action}Response xmlns:u="urn:Belkin:service:{service}:1">
+{body}
+</u:{action}Response>
+</s:Body>
+</s:Envelope>"""
+
+NOTIFY_XML = """<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">
+<e:property>
+<{name}>{value}</{name}>
+</e:property>
+</e:propertyset>"""
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class FakeWemoDevice(object):
+	def __init__(self, name="Fake Wemo", serial=None, insight=False, host="127.0.0.1", port=0,
+				 latency=0, jitter=0, failure_rate=0):
+		self.name = name
+		self.serial = serial or "FAKE%08X" % random.getrandbits(32)
+		self.insight = insight
+		self.latency = latency
+		self.jitter = jitter
+		self.failure_rate = failure_rate
+		self.state = 0
+		self.requests = 0
+		self._subscribers = {}
+		self._lock = threading.Lock()
+		self._started = time.time()
+		self._on_since = None
+		self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+		self._thread = None
+
+	@property
+	def host(self):
+		return self._server.server_address[0]
+
+	@property
+	def port(self):
+		return self._server.server_address[1]
+
+	@property
+	def address(self):
+		return "%s:%s" % (self.host, self.port)
+
+	def start(self):
+		self._thread = threading.Thread(target=self._server.serve_forever, name="FakeWemo %s" % self.serial)
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def set_state(self, state, notify=True):
+		"""Flip the relay as if the physical button was pressed."""
+		with self._lock:
+			changed = self.state != state
+			self.state = state
+			self._on_since = time.time() if state else None
+		if changed and notify:
+			self.notify("BinaryState", self._binary_state())
+
+	def notify(self, name, value):
+		with self._lock:
+			subscribers = list(self._subscribers.items())
+		for sid, (callback, seq) in subscribers:
+			self._send_notify(sid, callback, seq, name, value)
+
+	def _send_notify(self, sid, callback, seq, name, value):
+		match = re.match(r"<?http://([^:/]+):(\d+)(/[^>]*)>?", callback)
+		if match is None:
+			return
+		body = NOTIFY_XML.format(name=name, value=value)
+		try:
+			conn = HTTPConnection(match.group(1), int(match.group(2)), timeout=5)
+			conn.request("NOTIFY", match.group(3), body=body, headers={
+				"Content-Type": 'text/xml; charset="utf-8"',
+				"NT": "upnp:event",
+				"NTS": "upnp:propchange",
+				"SID": sid,
+				"SEQ": str(seq)})
+			conn.getresponse().read()
+			conn.close()
+		except (socket.error, IOError):
+			pass
+		with self._lock:
+			if sid in self._subscribers:
+				self._subscribers[sid] = (callback, seq + 1)
+
+	def _binary_state(self):
+		if not self.insight:
+			return str(self.state)
+		return "%s|%d|0|0|0|1209600|0|0|0|0|8000" % (self.state, int(self._started))
+
+	def _insight_params(self):
+		current_mw = 0
+		on_for = 0
+		if self.state:
+			current_mw = 40000 + random.randint(0, 20000)
+			on_for = int(time.time() - (self._on_since or time.time()))
+		return "%s|%d|%d|%d|%d|1209600|-50|%d|%d|%d|8000" % (
+			self.state, int(self._started), on_for, on_for, on_for, current_mw,
+			current_mw * 60, current_mw * 600)
+
+	def _setup_xml(self):
+		services = ["basicevent"]
+		if self.insight:
+			services.append("insight")
+		model = "Insight" if self.insight else "Socket"
+		return SETUP_XML.format(
+			device_type="insight" if self.insight else "controllee",
+			name=self.name,
+			model=model,
+			serial=self.serial,
+			mac=self.serial[-12:].rjust(12, "0"),
+			state=self.state,
+			services="\n".join(SERVICE_XML.format(name=s) for s in services))
+
+	def _scpd_xml(self, service):
+		actions = SERVICE_ACTIONS.get(service, [])
+		return SCPD_XML.format(actions="\n".join(
+			ACTION_XML.format(name=n, argument=a, direction=d) for n, a, d in actions))
+
+	def _soap(self, service, action, body):
+		if action == "GetBinaryState":
+			return "<BinaryState>%s</BinaryState>" % self._binary_state()
+		if action == "SetBinaryState":
+			match = re.search(r"<BinaryState>(\d+)</BinaryState>", body)
+			if match is None:
+				return None
+			self.set_state(int(match.group(1)))
+			return "<BinaryState>%s</BinaryState>" % self.state
+		if action == "GetInsightParams" and self.insight:
+			return "<InsightParams>%s</InsightParams>" % self._insight_params()
+		return None
+
+	def _subscribe(self, headers):
+		sid = headers.get("SID")
+		with self._lock:
+			if sid:
+				if sid not in self._subscribers:
+					return None
+			else:
+				sid = "uuid:%s" % uuid.uuid4()
+				self._subscribers[sid] = (headers.get("CALLBACK", ""), 0)
+			callback, seq = self._subscribers[sid]
+		if not headers.get("SID"):
+			# initial event as required by UPnP, sent once the response is out
+			t = threading.Timer(0.05, self._send_notify, args=[sid, callback, seq, "BinaryState", self._binary_state()])
+			t.daemon = True
+			t.start()
+		return sid
+
+	def _unsubscribe(self, headers):
+		with self._lock:
+			return self._subscribers.pop(headers.get("SID"), None) is not None
+
+	def _handler_class(self):
+		device = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			# headers and body go out as separate writes, don't let Nagle hold the body back on kept-alive sockets
+			disable_nagle_algorithm = True
+
+			def _reply(self, status, body="", content_type="text/xml", headers=None):
+				data = body.encode("utf-8")
+				self.send_response(status)
+				self.send_header("Content-Type", content_type)
+				self.send_header("Content-Length", str(len(data)))
+				for k, v in (headers or {}).items():
+					self.send_header(k, v)
+				self.end_headers()
+				self.wfile.write(data)
+
+			def _before(self):
+				device.requests += 1
+				delay = device.latency + random.uniform(0, device.jitter)
+				if delay > 0:
+					time.sleep(delay)
+				if (device.failure_rate and random.random() < device.failure_rate) or not device.before_request(self):
+					# dropped without a reply, close so the client sees it right away
+					self.close_connection = True
+					return False
+				return True
+
+			def do_GET(self):
+				if not self._before():
+					return
+				if self.path == "/setup.xml":
+					self._reply(200, device._setup_xml())
+					return
+				match = re.match(r"^/(\w+)service\.xml$", self.path)
+				if match and match.group(1) in SERVICE_ACTIONS:
+					self._reply(200, device._scpd_xml(match.group(1)))
+					return
+				self._reply(404, "")
+
+			def do_POST(self):
+				length = int(self.headers.get("Content-Length", 0))
+				body = self.rfile.read(length).decode("utf-8") if length else ""
+				if not self._before():
+					return
+				match = re.match(r'^"?urn:Belkin:service:(\w+):1#(\w+)"?$', self.headers.get("SOAPACTION", ""))
+				if match is None:
+					self._reply(500, "")
+					return
+				service, action = match.groups()
+				result = device._soap(service, action, body)
+				if result is None:
+					self._reply(500, "")
+					return
+				self._reply(200, SOAP_RESPONSE.format(action=action, service=service, body=result))
+
+			def do_SUBSCRIBE(self):
+				if not self._before():
+					return
+				sid = device._subscribe(self.headers)
+				if sid is None:
+					self._reply(412, "")
+					return
+				self._reply(200, "", headers={"SID": sid, "TIMEOUT": "Second-300"})
+
+			def do_UNSUBSCRIBE(self):
+				if not self._before():
+					return
+				self._reply(200 if device._unsubscribe(self.headers) else 412, "")
+
+			def log_message(self, format, *args):
+				pass
+
+		return Handler
+
+	def before_request(self, handler):
+		"""Hook for subclasses to delay or drop a request, return False to drop it."""
+		return True
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve fake Wemo devices on loopback.")
+	parser.add_argument("--count", type=int, default=1, help="number of devices to start")
+	parser.add_argument("--insight", action="store_true", help="emulate Insight plugs")
+	parser.add_argument("--toggle", type=float, default=0, help="flip every device's relay every N seconds")
+	parser.add_argument("--latency", type=float, default=0, help="seconds to delay every request")
+	parser.add_argument("--jitter", type=float, default=0, help="up to this many extra seconds of random delay")
+	parser.add_argument("--failure-rate", type=float, default=0, help="fraction of requests to drop, 0 to 1")
+	args = parser.parse_args()
+
+	devices = [FakeWemoDevice(name="Fake Wemo %d" % (i + 1), insight=args.insight, latency=args.latency,
+							  jitter=args.jitter, failure_rate=args.failure_rate).start() for i in range(args.count)]
+	for device in devices:
+		print("%s %s" % (device.address, device.serial))
+
+	try:
+		while True:
+			if args.toggle:
+				time.sleep(args.toggle)
+				for device in devices:
+					device.set_state(0 if device.state else 1)
+			else:
+				time.sleep(3600)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for device in devices:
+			device.stop()
+
+
+if __name__ == "__main__":
+	main()
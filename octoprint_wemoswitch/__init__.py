@@ -5,69 +5,1313 @@ import octoprint.plugin
 from octoprint.access.permissions import Permissions, ADMIN_GROUP, USER_GROUP
 from flask_babel import gettext
 from octoprint.events import eventManager, Events
-from octoprint.util import RepeatedTimer
+from octoprint.util import RepeatedTimer, monotonic_time
 import socket
 import flask
+import array
+import bisect
+import collections
+import contextlib
+import functools
+import heapq
+import itertools
+import json
 import logging
+import math
 import os
-import re
+import signal
+import stat
+import struct
+import subprocess
+import tempfile
 import threading
 import time
-import pywemo
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from octoprint.util.version import is_octoprint_compatible
-from uptime import uptime
-
-try:
-	from octoprint.util import ResettableTimer
-except ImportError:
-	class ResettableTimer(threading.Thread):
-		def __init__(self, interval, function, args=None, kwargs=None, on_reset=None, on_cancelled=None):
-			threading.Thread.__init__(self)
-			self._event = threading.Event()
-			self._mutex = threading.Lock()
-			self.is_reset = True
-
-			if args is None:
-				args = []
-			if kwargs is None:
-				kwargs = dict()
-
-			self.interval = interval
+
+DISCOVERY_CACHE_TTL = 300
+HOSTNAME_CACHE_TTL = 300
+DEVICE_CONNECT_TIMEOUT = 2.0
+DEVICE_READ_TIMEOUT = 5.0
+DEVICE_RETRIES = 1
+DEVICE_POOL_SIZE = 2
+CIRCUIT_FAILURE_THRESHOLD = 2
+CIRCUIT_BACKOFF_MIN = 10
+CIRCUIT_BACKOFF_MAX = 600
+FAN_OUT_WORKERS = 8
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+POWER_OFF_JOB_HISTORY = 100
+POWER_OFF_WAIT_TIMEOUT = 30
+UPLOAD_PRINT_TIMEOUT = 60
+COMMAND_KILL_GRACE = 5
+COMMAND_CONCURRENCY = 2
+COMMAND_HISTORY = 50
+COMMAND_OUTPUT_TAIL = 4096
+# tier name, seconds averaged into one entry, entries kept
+POWER_HISTORY_TIERS = (("raw", None, 1440), ("minute", 60, 1440), ("hour", 3600, 2160))
+POWER_SPARKLINE_POINTS = 60
+SHARED_DIRECTORY = "octoprint-wemoswitch-%d"
+SHARED_SOCKET = "devices.sock"
+SHARED_RETRY_DELAY = 1.0
+SHARED_REQUEST_TIMEOUT = 30.0
+SHARED_ELECTION_TIMEOUT = 2.0
+
+
+def load_pywemo():
+	"""
+	pywemo brings requests and lxml along, so it's imported on the first device
+	operation or discovery instead of when OctoPrint loads the plugin.
+	"""
+	import pywemo
+	return pywemo
+
+
+class DeviceUnreachable(Exception):
+	pass
+
+
+class SharedRequestPending(DeviceUnreachable):
+	pass
+
+
+class DeadlineScheduler(threading.Thread):
+	"""
+	Runs callbacks at monotonic deadlines from a single thread.
+
+	Jobs live in a heap ordered by deadline and the thread only wakes up when
+	the earliest one is due. Named jobs replace any pending job with the same
+	name. Callbacks that block on I/O should be scheduled with ``offload=True``
+	so they are handed to ``executor`` instead of stalling the queue.
+	"""
+
+	class Job(object):
+		__slots__ = ("deadline", "function", "args", "kwargs", "name", "offload", "cancelled")
+
+		def __init__(self, deadline, function, args, kwargs, name, offload):
+			self.deadline = deadline
 			self.function = function
 			self.args = args
 			self.kwargs = kwargs
-			self.on_cancelled = on_cancelled
-			self.on_reset = on_reset
-
-		def run(self):
-			while self.is_reset:
-				with self._mutex:
-					self.is_reset = False
-				self._event.wait(self.interval)
-
-			if not self._event.isSet():
-				self.function(*self.args, **self.kwargs)
-			with self._mutex:
-				self._event.set()
-
-		def cancel(self):
-			with self._mutex:
-				self._event.set()
-
-			if callable(self.on_cancelled):
-				self.on_cancelled()
-
-		def reset(self, interval=None):
-			with self._mutex:
-				if interval:
-					self.interval = interval
-
-				self.is_reset = True
-				self._event.set()
+			self.name = name
+			self.offload = offload
+			self.cancelled = False
+
+	def __init__(self, executor=None, logger=None):
+		threading.Thread.__init__(self, name="WemoSwitch Scheduler")
+		self.daemon = True
+		self._queue = []
+		self._named = {}
+		self._counter = itertools.count()
+		self._condition = threading.Condition()
+		self._stopped = False
+		self._executor = executor if executor is not None else self._spawn
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+	def schedule(self, delay, function, args=None, kwargs=None, name=None, offload=False):
+		return self.schedule_at(monotonic_time() + max(delay, 0), function, args=args, kwargs=kwargs, name=name, offload=offload)
+
+	def schedule_at(self, deadline, function, args=None, kwargs=None, name=None, offload=False):
+		job = self.Job(deadline, function, args or [], kwargs or {}, name, offload)
+		with self._condition:
+			if name is not None:
+				previous = self._named.get(name)
+				if previous is not None:
+					previous.cancelled = True
+				self._named[name] = job
+			heapq.heappush(self._queue, (deadline, next(self._counter), job))
+			if self._queue[0][2] is job:
+				self._condition.notify()
+		return job
+
+	def cancel(self, name):
+		with self._condition:
+			job = self._named.pop(name, None)
+			if job is None:
+				return False
+			job.cancelled = True
+			return True
+
+	def is_scheduled(self, name):
+		with self._condition:
+			return name in self._named
+
+	def stop(self):
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+
+	def run(self):
+		while True:
+			with self._condition:
+				while not self._stopped:
+					if self._queue and self._queue[0][2].cancelled:
+						heapq.heappop(self._queue)
+						continue
+					timeout = self._queue[0][0] - monotonic_time() if self._queue else None
+					if timeout is not None and timeout <= 0:
+						break
+					self._condition.wait(timeout)
+				if self._stopped:
+					return
+				job = heapq.heappop(self._queue)[2]
+				if job.name is not None and self._named.get(job.name) is job:
+					del self._named[job.name]
+
+			if job.offload:
+				self._executor(job.function, job.args, job.kwargs)
+			else:
+				self._execute(job.function, job.args, job.kwargs)
+
+	def _execute(self, function, args, kwargs):
+		try:
+			function(*args, **kwargs)
+		except Exception:
+			self._logger.exception("Error running scheduled job %r" % function)
+
+	def _spawn(self, function, args, kwargs):
+		t = threading.Thread(target=self._execute, args=[function, args, kwargs])
+		t.daemon = True
+		t.start()
+
+
+class LatestValueWorker(threading.Thread):
+	"""
+	Hands values to ``function`` on a single thread. Only the most recent value
+	is kept, anything that arrives while ``function`` is busy replaces it.
+	"""
+
+	def __init__(self, function, name, logger=None):
+		threading.Thread.__init__(self, name=name)
+		self.daemon = True
+		self._function = function
+		self._value = None
+		self._lock = threading.Lock()
+		self._event = threading.Event()
+		self._stopped = False
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+	def put(self, value):
+		with self._lock:
+			self._value = value
+		self._event.set()
+
+	def stop(self):
+		self._stopped = True
+		self._event.set()
+
+	def run(self):
+		while True:
+			self._event.wait()
+			if self._stopped:
+				return
+			with self._lock:
+				value = self._value
+				self._value = None
 				self._event.clear()
+			if value is None:
+				continue
+			try:
+				self._function(value)
+			except Exception:
+				self._logger.exception("Error processing %r" % value)
+
+
+class PlugFanOut(object):
+	"""
+	Runs one call per plug on a bounded thread pool, so a group command takes as
+	long as the slowest plug instead of the sum of all of them.
+	"""
+
+	def __init__(self, max_workers=FAN_OUT_WORKERS, name="WemoSwitch FanOut", logger=None):
+		self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+	def run(self, plugips, function, critical=()):
+		"""
+		Calls ``function(plugip)`` for every plug and waits for all of them.
+		Plugs in ``critical`` are queued first in case there are more plugs than
+		workers. Returns ``(results, elapsed)``, with results mapping each plug to
+		a dict of its return value, error and elapsed seconds.
+		"""
+		plugips = sorted(set(plugips), key=lambda plugip: plugip not in critical)
+		start = monotonic_time()
+		futures = dict((self._executor.submit(self._call, function, plugip), plugip) for plugip in plugips)
+		wait(futures)
+		results = dict((plugip, future.result()) for future, plugip in futures.items())
+		return results, monotonic_time() - start
+
+	def shutdown(self):
+		self._executor.shutdown(wait=False)
+
+	def _call(self, function, plugip):
+		start = monotonic_time()
+		try:
+			return dict(result=function(plugip), error=None, elapsed=monotonic_time() - start)
+		except Exception as e:
+			self._logger.exception("Error processing %s" % plugip)
+			return dict(result=None, error=repr(e), elapsed=monotonic_time() - start)
+
+
+class HostResolver(object):
+	"""
+	Caches hostname lookups for ``ttl`` seconds. Expired entries are still
+	served while a background refresh runs, and a failed lookup keeps the last
+	known good address, so only the very first lookup of a name ever blocks.
+	"""
+
+	def __init__(self, ttl=HOSTNAME_CACHE_TTL, logger=None):
+		self.ttl = ttl
+		self._entries = {}
+		self._refreshing = set()
+		self._lock = threading.Lock()
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+		self.hits = 0
+		self.stale_hits = 0
+		self.misses = 0
+		self.failures = 0
+
+	def resolve(self, host):
+		try:
+			socket.inet_aton(host)
+			return host
+		except (socket.error, ValueError):
+			pass
+
+		with self._lock:
+			entry = self._entries.get(host)
+			if entry is not None:
+				address, expires = entry
+				if expires > monotonic_time():
+					self.hits += 1
+					return address
+				self.stale_hits += 1
+				if host not in self._refreshing:
+					self._refreshing.add(host)
+					t = threading.Thread(target=self._refresh, args=[host])
+					t.daemon = True
+					t.start()
+				return address
+			self.misses += 1
+
+		return self._lookup(host)
+
+	def prefetch(self, hosts):
+		t = threading.Thread(target=self._prefetch, args=[list(hosts)])
+		t.daemon = True
+		t.start()
+
+	def _prefetch(self, hosts):
+		for host in hosts:
+			self.resolve(host)
+
+	def stats(self):
+		with self._lock:
+			return dict(entries=len(self._entries), hits=self.hits, stale_hits=self.stale_hits,
+						misses=self.misses, failures=self.failures)
+
+	def _refresh(self, host):
+		try:
+			self._lookup(host)
+		finally:
+			with self._lock:
+				self._refreshing.discard(host)
+
+	def _lookup(self, host):
+		try:
+			address = socket.gethostbyname(host)
+		except (socket.herror, socket.gaierror):
+			with self._lock:
+				self.failures += 1
+				entry = self._entries.get(host)
+			if entry is not None:
+				self._logger.debug("Lookup of %s failed, keeping last known address %s." % (host, entry[0]))
+				return entry[0]
+			return None
+
+		with self._lock:
+			self._entries[host] = (address, monotonic_time() + self.ttl)
+		return address
+
+
+class PlugHealth(object):
+	"""
+	Circuit breaker for one plug. After ``threshold`` consecutive failures the
+	circuit opens and calls are refused until the backoff runs out, then a
+	single trial call is let through (half open). A success closes the circuit
+	again, a failure reopens it with twice the backoff. Failures of calls made
+	past an open circuit don't extend the backoff.
+	"""
+
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half_open"
+
+	def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, min_backoff=CIRCUIT_BACKOFF_MIN, max_backoff=CIRCUIT_BACKOFF_MAX):
+		self.threshold = threshold
+		self.min_backoff = min_backoff
+		self.max_backoff = max_backoff
+		self.state = self.CLOSED
+		self.failures = 0
+		self.backoff = 0
+		self.retry_at = None
+		self.last_error = None
+		self._lock = threading.Lock()
+
+	def allow(self):
+		with self._lock:
+			if self.state == self.CLOSED:
+				return True
+			if self.state == self.OPEN and monotonic_time() >= self.retry_at:
+				self.state = self.HALF_OPEN
+				return True
+			return False
+
+	def record_success(self):
+		with self._lock:
+			self.state = self.CLOSED
+			self.failures = 0
+			self.backoff = 0
+			self.retry_at = None
+			self.last_error = None
+
+	def record_failure(self, error=None):
+		"""Returns True if this failure opened the circuit."""
+		with self._lock:
+			self.failures += 1
+			self.last_error = error
+			if self.state == self.OPEN or (self.state == self.CLOSED and self.failures < self.threshold):
+				return False
+			self.backoff = min(self.backoff * 2, self.max_backoff) if self.backoff else self.min_backoff
+			self.retry_at = monotonic_time() + self.backoff
+			self.state = self.OPEN
+			return True
+
+	def retry_in(self):
+		with self._lock:
+			if self.retry_at is None:
+				return 0
+			return max(self.retry_at - monotonic_time(), 0)
+
+	def stats(self):
+		retry_in = self.retry_in()
+		with self._lock:
+			return dict(state=self.state, failures=self.failures, backoff=self.backoff,
+						retry_in=retry_in, last_error=self.last_error)
+
+
+class DevicePools(object):
+	"""
+	One bounded keep-alive connection pool per device address, shared by every
+	request to that plug, so polls and toggles reuse an open socket instead of
+	connecting for each SOAP call. Pools block at ``maxsize`` connections so a
+	busy plug queues requests rather than having more sockets opened on it.
+	Devices that close the connection after each reply simply show up as new
+	connections in ``stats()``.
+	"""
+
+	def __init__(self, maxsize=DEVICE_POOL_SIZE):
+		self.maxsize = maxsize
+		self._pools = {}
+		self._closed = {}
+		self._lock = threading.Lock()
+
+	def get(self, host, port):
+		import urllib3
+		with self._lock:
+			pool = self._pools.get((host, port))
+			if pool is None:
+				pool = self._pools[(host, port)] = urllib3.HTTPConnectionPool(
+					host, port, maxsize=self.maxsize, block=True,
+					timeout=urllib3.Timeout(connect=DEVICE_CONNECT_TIMEOUT, read=DEVICE_READ_TIMEOUT))
+			return pool
+
+	def close(self, host=None, port=None):
+		with self._lock:
+			if host is None:
+				pools = list(self._pools.items())
+				self._pools.clear()
+			else:
+				pool = self._pools.pop((host, port), None)
+				pools = [((host, port), pool)] if pool is not None else []
+			# keep the counters of closed pools so the totals survive reconnects
+			for address, pool in pools:
+				requests, connections = self._closed.get(address, (0, 0))
+				self._closed[address] = (requests + pool.num_requests, connections + pool.num_connections)
+		for address, pool in pools:
+			pool.close()
+
+	def stats(self):
+		with self._lock:
+			totals = dict(self._closed)
+			for address, pool in self._pools.items():
+				requests, connections = totals.get(address, (0, 0))
+				totals[address] = (requests + pool.num_requests, connections + pool.num_connections)
+			open_pools = set(self._pools)
+		return dict(("%s:%s" % address, dict(requests=requests, connections=connections,
+											 reused=max(requests - connections, 0), open=address in open_pools))
+					for address, (requests, connections) in totals.items())
+
+
+class PooledSession(object):
+	"""
+	Stands in for a pywemo device's ``session`` and sends its requests through
+	the shared ``DevicePools`` with short timeouts and retries, unreachable
+	plugs are handled by the circuit breaker instead.
+	"""
+
+	def __init__(self, session, pools, timeout=DEVICE_READ_TIMEOUT, retries=DEVICE_RETRIES):
+		self._session = session
+		self._pools = pools
+		self.timeout = timeout
+		self.retries = retries
+
+	@property
+	def url(self):
+		return self._session.url
+
+	@url.setter
+	def url(self, url):
+		# pywemo moves the session when a device comes back on another port
+		self._session.url = url
+
+	@property
+	def host(self):
+		return self._session.host
+
+	@property
+	def port(self):
+		return self._session.port
+
+	def urljoin(self, path):
+		return self._session.urljoin(path)
+
+	def get(self, url, **kwargs):
+		return self.request("GET", url, **kwargs)
+
+	def post(self, url, **kwargs):
+		return self.request("POST", url, **kwargs)
+
+	def request(self, method, url, retries=None, timeout=None, **kwargs):
+		import urllib3
+		from pywemo.exceptions import HTTPException, HTTPNotOkException
+
+		if retries is None:
+			retries = self.retries
+		if timeout is None:
+			timeout = self.timeout
+		if not isinstance(retries, urllib3.Retry):
+			# a kept-alive socket the device dropped fails on reuse, SOAP actions are safe to repeat
+			retries = urllib3.Retry(total=retries, allowed_methods=["GET", "POST"])
+
+		parsed = urllib3.util.parse_url(url)
+		pool = self._pools.get(parsed.host, parsed.port or 80)
+		try:
+			response = pool.request(method, parsed.request_uri, retries=retries, pool_timeout=timeout,
+									timeout=urllib3.Timeout(connect=min(DEVICE_CONNECT_TIMEOUT, timeout), read=timeout),
+									**kwargs)
+		except urllib3.exceptions.HTTPError as e:
+			raise HTTPException(e)
+		if response.status != 200:
+			raise HTTPNotOkException("Received status %s for %s" % (response.status, url))
+		response.content = response.data
+		return response
+
+
+class PowerOffJob(object):
+	"""One run of the power off sequence of a plug, completed by the scheduler."""
+
+	def __init__(self, plugip):
+		self.id = uuid.uuid4().hex
+		self.ip = plugip
+		self.status = "pending"
+		self.state = None
+		self.started = time.time()
+		self.finished = None
+		self._done = threading.Event()
+
+	def finish(self, success, state):
+		self.status = "done" if success else "failed"
+		self.state = state
+		self.finished = time.time()
+		self._done.set()
+
+	def wait(self, timeout=None):
+		return self._done.wait(timeout)
+
+	def to_dict(self):
+		return dict(job_id=self.id, ip=self.ip, status=self.status, currentState=self.state,
+					started=self.started, finished=self.finished)
+
+
+class CommandRun(object):
+	"""One run of a plug's sysRunCmdOn or sysRunCmdOff command."""
+
+	def __init__(self, plugip, action, command, timeout=None):
+		self.id = uuid.uuid4().hex
+		self.ip = plugip
+		self.action = action
+		self.command = command
+		self.timeout = timeout
+		self.status = "queued"
+		self.exit_code = None
+		self.output = ""
+		self.queued = time.time()
+		self.started = None
+		self.finished = None
+		self.duration = None
+
+	def to_dict(self):
+		return dict(id=self.id, ip=self.ip, action=self.action, command=self.command, timeout=self.timeout, status=self.status,
+					exit_code=self.exit_code, output=self.output, queued=self.queued, started=self.started,
+					finished=self.finished, duration=self.duration)
+
+
+class CommandRunner(object):
+	"""
+	Runs plug commands through a shell with at most ``concurrency`` at a time.
+	A command still queued or running for the same plug and action isn't
+	started again, and one that outlives the timeout it was started with has
+	its whole process group terminated, then killed. The last ``history`` runs are kept with
+	their exit code, duration and the last ``tail`` bytes of output.
+	"""
+
+	def __init__(self, concurrency=COMMAND_CONCURRENCY, history=COMMAND_HISTORY, tail=COMMAND_OUTPUT_TAIL, logger=None):
+		self.tail = tail
+		self.history = history
+		self._slots = threading.Semaphore(concurrency)
+		self._runs = collections.OrderedDict()
+		self._active = {}
+		self._lock = threading.Lock()
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+
+	def run(self, plugip, action, command, timeout=None):
+		"""
+		Runs ``command`` on the calling thread once a slot is free and returns
+		its CommandRun, or None if the same command is already underway. Without
+		a ``timeout`` the command may run as long as it likes.
+		"""
+		with self._lock:
+			active = self._active.get((plugip, action))
+			if active is not None:
+				self._logger.debug("Command %s for %s is still %s, not starting it again." % (action, plugip, active.status))
+				return None
+			run = self._active[(plugip, action)] = CommandRun(plugip, action, command, timeout or None)
+			self._runs[run.id] = run
+			while len(self._runs) > self.history:
+				self._runs.popitem(last=False)
+
+		try:
+			with self._slots:
+				self._execute(run)
+		finally:
+			with self._lock:
+				self._active.pop((plugip, action), None)
+		self._logger.debug("Command %s for %s %s with exit code %s after %.2fs: %s" % (action, plugip, run.status, run.exit_code,
+																					  run.duration, run.output[-200:]))
+		return run
+
+	def get(self, run_id):
+		with self._lock:
+			return self._runs.get(run_id)
+
+	def runs(self):
+		with self._lock:
+			return list(reversed(self._runs.values()))
+
+	def _execute(self, run):
+		run.status = "running"
+		run.started = time.time()
+		start = monotonic_time()
+		output = bytearray()
+		try:
+			# a session of its own lets a timeout take down everything the shell started
+			process = subprocess.Popen(run.command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+									   stderr=subprocess.STDOUT, start_new_session=os.name == "posix")
+		except (OSError, ValueError) as e:
+			run.status = "failed"
+			run.output = str(e)
+		else:
+			reader = threading.Thread(target=self._read_tail, args=[process.stdout, output])
+			reader.daemon = True
+			reader.start()
+			try:
+				run.exit_code = process.wait(run.timeout)
+				run.status = "done" if run.exit_code == 0 else "failed"
+			except subprocess.TimeoutExpired:
+				self._signal(process, False)
+				try:
+					process.wait(COMMAND_KILL_GRACE)
+				except subprocess.TimeoutExpired:
+					self._signal(process, True)
+					process.wait()
+				run.exit_code = process.returncode
+				run.status = "timeout"
+			# anything left running in the background may hold the pipe open
+			reader.join(1)
+			run.output = bytes(output).decode("utf-8", "replace")
+		run.finished = time.time()
+		run.duration = monotonic_time() - start
+
+	def _read_tail(self, stream, output):
+		with stream:
+			for chunk in iter(functools.partial(stream.read1, 4096), b""):
+				output.extend(chunk)
+				del output[:-self.tail]
+
+	@staticmethod
+	def _signal(process, kill):
+		try:
+			if os.name == "posix":
+				os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+			elif kill:
+				process.kill()
+			else:
+				process.terminate()
+		except OSError:
+			pass
+
+
+class PlugMetrics(object):
+	"""
+	Call counts, error counts and latency histograms per plug and operation,
+	plus plain event counters. Histograms count into the fixed ``buckets`` so
+	memory stays constant and they export to Prometheus as they are.
+	"""
+
+	def __init__(self, buckets=METRIC_BUCKETS):
+		self.buckets = tuple(buckets)
+		self._operations = {}
+		self._events = {}
+		self._lock = threading.Lock()
+
+	def observe(self, plugip, operation, elapsed, error=False):
+		index = bisect.bisect_left(self.buckets, elapsed)
+		with self._lock:
+			entry = self._operations.get((plugip, operation))
+			if entry is None:
+				# calls, errors, sum of latencies, bucket counts with +Inf last
+				entry = self._operations[(plugip, operation)] = [0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+			entry[0] += 1
+			if error:
+				entry[1] += 1
+			entry[2] += elapsed
+			entry[3][index] += 1
+
+	@contextlib.contextmanager
+	def timed(self, plugip, operation):
+		start = monotonic_time()
+		try:
+			yield
+		except Exception:
+			self.observe(plugip, operation, monotonic_time() - start, error=True)
+			raise
+		self.observe(plugip, operation, monotonic_time() - start)
+
+	def count(self, event):
+		with self._lock:
+			self._events[event] = self._events.get(event, 0) + 1
+
+	def retain(self, plugips):
+		with self._lock:
+			for key in list(self._operations.keys()):
+				if key[0] not in plugips:
+					del self._operations[key]
+
+	def _snapshot(self):
+		with self._lock:
+			operations = dict((key, (entry[0], entry[1], entry[2], list(entry[3]))) for key, entry in self._operations.items())
+			return operations, dict(self._events)
+
+	def _cumulative(self, counts):
+		labels = ["%g" % bucket for bucket in self.buckets] + ["+Inf"]
+		total = 0
+		for label, count in zip(labels, counts):
+			total += count
+			yield label, total
+
+	def to_dict(self):
+		operations, events = self._snapshot()
+		plugs = {}
+		for (plugip, operation), (calls, errors, total, counts) in operations.items():
+			plugs.setdefault(plugip, {})[operation] = dict(calls=calls, errors=errors, sum=total,
+														  buckets=dict(self._cumulative(counts)))
+		return dict(plugs=plugs, events=events)
+
+	def to_prometheus(self):
+		operations, events = self._snapshot()
+		lines = ["# HELP wemoswitch_operation_duration_seconds Latency of plug operations.",
+				 "# TYPE wemoswitch_operation_duration_seconds histogram"]
+		for (plugip, operation), (calls, errors, total, counts) in sorted(operations.items()):
+			labels = 'plug="%s",operation="%s"' % (self._escape(plugip), operation)
+			for le, count in self._cumulative(counts):
+				lines.append('wemoswitch_operation_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, count))
+			lines.append("wemoswitch_operation_duration_seconds_sum{%s} %r" % (labels, total))
+			lines.append("wemoswitch_operation_duration_seconds_count{%s} %d" % (labels, calls))
+		lines += ["# HELP wemoswitch_operation_errors_total Failed plug operations.",
+				  "# TYPE wemoswitch_operation_errors_total counter"]
+		for (plugip, operation), (calls, errors, total, counts) in sorted(operations.items()):
+			lines.append('wemoswitch_operation_errors_total{plug="%s",operation="%s"} %d' % (self._escape(plugip), operation, errors))
+		lines += ["# HELP wemoswitch_events_total Idle timer and abort countdown events.",
+				  "# TYPE wemoswitch_events_total counter"]
+		for event, count in sorted(events.items()):
+			lines.append('wemoswitch_events_total{event="%s"} %d' % (event, count))
+		return "\n".join(lines) + "\n"
+
+	@staticmethod
+	def _escape(value):
+		return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RingBuffer(object):
+	"""
+	A fixed number of (timestamp, value) pairs in two preallocated arrays, once
+	full every append overwrites the oldest pair.
+	"""
+
+	def __init__(self, size):
+		self.size = size
+		self._times = array.array("d", [0.0]) * size
+		self._values = array.array("d", [0.0]) * size
+		self._next = 0
+		self._count = 0
+
+	def __len__(self):
+		return self._count
+
+	@property
+	def full(self):
+		return self._count == self.size
+
+	def append(self, timestamp, value):
+		self._times[self._next] = timestamp
+		self._values[self._next] = value
+		self._next = (self._next + 1) % self.size
+		self._count = min(self._count + 1, self.size)
+
+	def oldest(self):
+		if not self._count:
+			return None
+		return self._times[(self._next - self._count) % self.size]
+
+	def items(self, start=None, end=None, last=None):
+		count = self._count if last is None else min(last, self._count)
+		points = []
+		for i in range(self._next - count, self._next):
+			timestamp = self._times[i % self.size]
+			if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+				points.append([timestamp, self._values[i % self.size]])
+		return points
+
+
+class PowerHistory(object):
+	"""
+	Power readings of one Insight plug. Every sample goes into the raw tier and
+	is averaged into the current minute and hour, which move to their own tiers
+	once they are over. All tiers are ring buffers, so memory stays the same
+	however long OctoPrint runs.
+	"""
+
+	tiers = POWER_HISTORY_TIERS
+
+	def __init__(self):
+		self._buffers = dict((name, RingBuffer(size)) for name, width, size in self.tiers)
+		self._buckets = {}
+		self.latest = None
+		self._lock = threading.Lock()
+
+	def add(self, timestamp, watts, latest=None):
+		with self._lock:
+			for name, width, size in self.tiers:
+				if width is None:
+					self._buffers[name].append(timestamp, watts)
+					continue
+				start = timestamp - timestamp % width
+				bucket = self._buckets.get(name)
+				if bucket is not None and bucket[0] != start:
+					self._buffers[name].append(bucket[0], bucket[1] / bucket[2])
+					bucket = None
+				if bucket is None:
+					bucket = self._buckets[name] = [start, 0.0, 0]
+				bucket[1] += watts
+				bucket[2] += 1
+			self.latest = latest
+
+	def query(self, start=None, end=None, tier=None):
+		with self._lock:
+			if tier is None:
+				tier = self._tier_for(start)
+			points = self._buffers[tier].items(start, end)
+			bucket = self._buckets.get(tier)
+			# the average of the minute or hour still in progress
+			if bucket is not None and (start is None or bucket[0] >= start) and (end is None or bucket[0] <= end):
+				points.append([bucket[0], bucket[1] / bucket[2]])
+			return tier, points
+
+	def recent(self, count):
+		with self._lock:
+			return self._buffers[self.tiers[0][0]].items(last=count)
+
+	def _tier_for(self, start):
+		# the finest tier reaching back to start, or still holding everything since recording began
+		for name, width, size in self.tiers:
+			buffer = self._buffers[name]
+			if not buffer.full or (start is not None and buffer.oldest() <= start):
+				return name
+		return self.tiers[-1][0]
+
+
+class WemoPlug(object):
+	"""Typed view of one entry of the arrSmartplugs setting."""
+
+	__slots__ = ("ip", "label", "icon", "displayWarning", "warnPrinting", "thermal_runaway", "gcodeEnabled",
+				 "gcodeOnDelay", "gcodeOffDelay", "autoConnect", "autoConnectDelay", "autoDisconnect",
+				 "autoDisconnectDelay", "sysCmdOn", "sysRunCmdOn", "sysCmdOnDelay", "sysCmdOnTimeout", "sysCmdOff",
+				 "sysRunCmdOff", "sysCmdOffDelay", "sysCmdOffTimeout", "automaticShutdownEnabled", "event_on_startup",
+				 "event_on_upload")
+
+	_flags = ("displayWarning", "warnPrinting", "thermal_runaway", "gcodeEnabled", "autoConnect", "autoDisconnect",
+			  "sysCmdOn", "sysCmdOff", "automaticShutdownEnabled", "event_on_startup", "event_on_upload")
+	_delays = ("gcodeOnDelay", "gcodeOffDelay", "autoConnectDelay", "autoDisconnectDelay", "sysCmdOnDelay",
+			   "sysCmdOnTimeout", "sysCmdOffDelay", "sysCmdOffTimeout")
+	_strings = ("ip", "label", "icon", "sysRunCmdOn", "sysRunCmdOff")
+
+	def __init__(self, data):
+		for key in self._flags:
+			setattr(self, key, data.get(key) is True)
+		for key in self._delays:
+			try:
+				setattr(self, key, float(data.get(key) or 0))
+			except (TypeError, ValueError):
+				setattr(self, key, 0.0)
+		for key in self._strings:
+			setattr(self, key, data.get(key) or "")
+
+	def __repr__(self):
+		return "WemoPlug(%s)" % ", ".join("%s=%r" % (key, getattr(self, key)) for key in self.__slots__)
+
+
+class WemoPlugRegistry(object):
+	"""
+	In-memory index of the configured plugs, rebuilt whenever settings change
+	so hot paths never have to go through the settings layer.
+	"""
+
+	def __init__(self, plugs=None):
+		self.plugs = tuple(WemoPlug(plug) for plug in plugs or [] if plug.get("ip"))
+		self.by_ip = dict((plug.ip, plug) for plug in self.plugs)
+		self.ips = tuple(plug.ip for plug in self.plugs)
+		self.thermal_runaway_plugs = tuple(plug for plug in self.plugs if plug.thermal_runaway)
+		self.automatic_shutdown_plugs = tuple(plug for plug in self.plugs if plug.automaticShutdownEnabled)
+		self.event_on_startup_plugs = tuple(plug for plug in self.plugs if plug.event_on_startup)
+		self.event_on_upload_plugs = tuple(plug for plug in self.plugs if plug.event_on_upload)
+
+	def get(self, plugip):
+		return self.by_ip.get(plugip)
+
+
+class SharedDevices(object):
+	"""
+	Shares device I/O between OctoPrint instances on one host over a Unix
+	socket. The instance holding the lock file next to the socket owns the
+	devices: it runs the commands the others forward and pushes plug state
+	changes to every instance watching that plug. The others only forward, so
+	a plug sees the same traffic however many instances use it. When the owner
+	goes away the next instance to get the lock takes over.
+
+	Messages are JSON objects, one per line. The socket and lock file have to
+	live in a directory only the current user can write to, and both ends check
+	the other one runs as the same user.
+	"""
+
+	OWNER = "owner"
+	CLIENT = "client"
+	COMMANDS = ("info", "on", "off")
+
+	def __init__(self, path, execute, states, on_state, on_role, on_watch=None, logger=None):
+		self.path = path
+		self.role = None
+		self._execute = execute
+		self._states = states
+		self._on_state = on_state
+		self._on_role = on_role
+		self._on_watch = on_watch
+		self._logger = logger if logger is not None else logging.getLogger(__name__)
+		self._lock = threading.Lock()
+		self._send_lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._elected = threading.Event()
+		self._lock_file = None
+		self._socket = None
+		self._peers = {}
+		self._watching = ()
+		self._pending = {}
+		self._inflight = {}
+		self._counter = itertools.count(1)
+		self._thread = None
+
+	@staticmethod
+	def default_path():
+		"""A socket in a per user directory in the temp dir, created if it doesn't exist yet."""
+		directory = os.path.join(tempfile.gettempdir(), SHARED_DIRECTORY % os.getuid())
+		try:
+			os.mkdir(directory, 0o700)
+		except OSError:
+			if not os.path.isdir(directory):
+				raise
+		return os.path.join(directory, SHARED_SOCKET)
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name="WemoSwitch Shared Devices")
+		self._thread.daemon = True
+		self._thread.start()
+		# so the plugin starts out in the role it ends up with
+		self._elected.wait(SHARED_ELECTION_TIMEOUT)
+
+	def stop(self):
+		self._stopped.set()
+		with self._lock:
+			sockets = list(self._peers.keys())
+			if self._socket is not None:
+				sockets.append(self._socket)
+		for sock in sockets:
+			self._close(sock)
+		if self._thread is not None:
+			self._thread.join(SHARED_RETRY_DELAY * 2)
+
+	def watch(self, plugips):
+		"""Sets the plugs this instance wants state changes for while another instance owns the devices."""
+		self._watching = tuple(plugips)
+		with self._lock:
+			sock = self._socket if self.role == self.CLIENT else None
+		if sock is not None:
+			self._send_quietly(sock, self._send_lock, dict(op="watch", ips=list(self._watching)))
+
+	def watched(self):
+		"""Plugs the other instances are watching, only known to the owner."""
+		with self._lock:
+			return set(itertools.chain.from_iterable(peer["ips"] for peer in self._peers.values()))
+
+	def broadcast(self, plugip, state):
+		if self.role != self.OWNER:
+			return
+		with self._lock:
+			peers = [(conn, peer) for conn, peer in self._peers.items() if plugip in peer["ips"]]
+		for conn, peer in peers:
+			self._send_quietly(conn, peer["lock"], dict(op="state", ip=plugip, state=state))
+
+	def request(self, cmd, plugip, timeout):
+		"""Runs ``cmd`` for ``plugip`` on the owner, raises DeviceUnreachable if the owner can't be reached."""
+		with self._lock:
+			sock = self._socket if self.role == self.CLIENT else None
+			if sock is None:
+				raise DeviceUnreachable("Not connected to the shared device owner")
+			request_id = next(self._counter)
+			entry = self._pending[request_id] = dict(done=threading.Event())
+		try:
+			self._send(sock, self._send_lock, dict(op="command", id=request_id, cmd=cmd, ip=plugip))
+			if not entry["done"].wait(timeout):
+				# the owner may still be talking to the plug, so this isn't retried locally
+				raise SharedRequestPending("No answer from the shared device owner within %ss" % timeout)
+		except socket.error as e:
+			raise DeviceUnreachable("Shared device owner went away: %r" % e)
+		finally:
+			with self._lock:
+				self._pending.pop(request_id, None)
+		if "error" in entry:
+			raise DeviceUnreachable(entry["error"])
+		return entry["result"]
+
+	def _run(self):
+		try:
+			self._check_directory()
+		except (OSError, ValueError) as e:
+			self._logger.warning("Not sharing plugs through %s: %s" % (self.path, e))
+			self._elected.set()
+			return
+
+		while not self._stopped.is_set():
+			try:
+				if self._acquire_lock():
+					self._serve()
+				else:
+					self._listen()
+			except (socket.error, ValueError) as e:
+				if not self._stopped.is_set():
+					self._logger.debug("Shared devices on %s: %r" % (self.path, e))
+			self._set_role(None)
+			self._elected.set()
+			self._stopped.wait(SHARED_RETRY_DELAY)
+		self._release_lock()
+
+	def _set_role(self, role):
+		previous, self.role = self.role, role
+		if role != previous and not self._stopped.is_set():
+			self._on_role(role)
+		# only after the callback, so start() returns with the plugin already set up for the role
+		self._elected.set()
+
+	def _check_directory(self):
+		# anyone else able to write there could take the lock or the socket and pose as the owner
+		directory = os.path.dirname(os.path.abspath(self.path))
+		st = os.lstat(directory)
+		if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+			raise ValueError("%s is not a directory owned by uid %s" % (directory, os.getuid()))
+		if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+			raise ValueError("%s is writable by other users" % directory)
+
+	@staticmethod
+	def _check_peer(sock):
+		if not hasattr(socket, "SO_PEERCRED"):
+			# elsewhere the directory permissions keep other users out
+			return
+		creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+		pid, uid, gid = struct.unpack("3i", creds)
+		if uid != os.getuid():
+			raise socket.error("Peer %s runs as uid %s" % (pid, uid))
+
+	def _acquire_lock(self):
+		import fcntl
+		if self._lock_file is None:
+			self._lock_file = os.fdopen(os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT, 0o600), "w")
+		try:
+			fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return True
+		except (IOError, OSError):
+			return False
+
+	def _release_lock(self):
+		# closing the file drops the lock
+		if self._lock_file is not None:
+			self._lock_file.close()
+			self._lock_file = None
+
+	def _serve(self):
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			# whoever holds the lock owns the path, anything left there is from an owner that died
+			if os.path.exists(self.path):
+				os.unlink(self.path)
+			server.bind(self.path)
+			os.chmod(self.path, 0o600)
+			server.listen(16)
+			server.settimeout(SHARED_RETRY_DELAY)
+			with self._lock:
+				self._socket = server
+			self._set_role(self.OWNER)
+			while not self._stopped.is_set():
+				try:
+					conn, address = server.accept()
+				except socket.timeout:
+					continue
+				try:
+					self._check_peer(conn)
+				except socket.error as e:
+					self._logger.warning("Refusing shared devices peer: %s" % e)
+					self._close(conn)
+					continue
+				conn.settimeout(None)
+				peer = dict(ips=set(), lock=threading.Lock())
+				with self._lock:
+					self._peers[conn] = peer
+				t = threading.Thread(target=self._serve_peer, args=[conn, peer])
+				t.daemon = True
+				t.start()
+		finally:
+			with self._lock:
+				self._socket = None
+			self._close(server)
+			try:
+				os.unlink(self.path)
+			except OSError:
+				pass
 
-			if callable(self.on_reset):
-				self.on_reset()
+	def _serve_peer(self, conn, peer):
+		try:
+			for message in self._messages(conn):
+				op = message.get("op")
+				if op == "watch":
+					ips = set(message.get("ips") or [])
+					with self._lock:
+						peer["ips"] = ips
+					self._send(conn, peer["lock"], dict(op="states", states=self._states(ips)))
+					if self._on_watch is not None:
+						self._on_watch(ips)
+				elif op == "command" and message.get("cmd") in self.COMMANDS:
+					t = threading.Thread(target=self._run_command, args=[conn, peer, message])
+					t.daemon = True
+					t.start()
+		except (socket.error, ValueError) as e:
+			self._logger.debug("Dropping shared devices peer: %r" % e)
+		finally:
+			with self._lock:
+				self._peers.pop(conn, None)
+			self._close(conn)
+
+	def _run_command(self, conn, peer, message):
+		try:
+			reply = dict(id=message.get("id"), result=self._coalesced(message["cmd"], message["ip"]))
+		except Exception as e:
+			reply = dict(id=message.get("id"), error=repr(e))
+		self._send_quietly(conn, peer["lock"], reply)
+
+	def _coalesced(self, cmd, plugip):
+		if cmd != "info":
+			return self._execute(cmd, plugip)
+
+		# instances asking for the same plug's state at the same time share one request
+		with self._lock:
+			entry = self._inflight.get(plugip)
+			first = entry is None
+			if first:
+				entry = self._inflight[plugip] = dict(done=threading.Event())
+		if not first:
+			entry["done"].wait()
+			if "error" in entry:
+				raise entry["error"]
+			return entry["result"]
+
+		try:
+			entry["result"] = self._execute(cmd, plugip)
+			return entry["result"]
+		except Exception as e:
+			entry["error"] = e
+			raise
+		finally:
+			with self._lock:
+				self._inflight.pop(plugip, None)
+			entry["done"].set()
+
+	def _listen(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			if os.lstat(self.path).st_uid != os.getuid():
+				raise ValueError("%s is not owned by uid %s" % (self.path, os.getuid()))
+			sock.connect(self.path)
+			self._check_peer(sock)
+			with self._lock:
+				self._socket = sock
+			self._set_role(self.CLIENT)
+			self._send(sock, self._send_lock, dict(op="watch", ips=list(self._watching)))
+			for message in self._messages(sock):
+				op = message.get("op")
+				if op == "state":
+					self._on_state(message.get("ip"), message.get("state"))
+				elif op == "states":
+					for plugip, state in (message.get("states") or {}).items():
+						self._on_state(plugip, state)
+				elif "id" in message:
+					with self._lock:
+						entry = self._pending.get(message["id"])
+					if entry is not None:
+						entry.update(message)
+						entry["done"].set()
+		finally:
+			with self._lock:
+				self._socket = None
+				pending = list(self._pending.values())
+			for entry in pending:
+				entry.setdefault("error", "Lost the connection to the shared device owner")
+				entry["done"].set()
+			self._close(sock)
+
+	@staticmethod
+	def _messages(sock):
+		with sock.makefile("rb") as stream:
+			for line in stream:
+				if line.strip():
+					yield json.loads(line.decode("utf-8"))
+
+	@staticmethod
+	def _send(sock, lock, message):
+		data = (json.dumps(message) + "\n").encode("utf-8")
+		with lock:
+			sock.sendall(data)
+
+	def _send_quietly(self, sock, lock, message):
+		try:
+			self._send(sock, lock, message)
+		except socket.error as e:
+			self._logger.debug("Could not send to shared devices peer: %r" % e)
+
+	@staticmethod
+	def _close(sock):
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		sock.close()
+
+
+class WemoConfig(collections.namedtuple("WemoConfig", (
+		"debug_logging", "abortTimeout", "powerOffWhenIdle", "idleTimeout", "idleIgnoreCommands", "idleIgnoreHeaters",
+		"idleTimeoutWaitTemp", "thermal_runaway_monitoring", "thermal_runaway_max_bed", "thermal_runaway_max_extruder",
+		"pollingEnabled", "pollingInterval", "subscriptionsEnabled", "event_on_upload_monitoring",
+		"event_on_startup_monitoring", "powerHistoryEnabled", "sharedDevicesEnabled", "sharedDevicesSocket",
+		"arrSmartplugs"))):
+	"""
+	Immutable, typed snapshot of the plugin settings. Hot paths read the
+	current snapshot instead of going through the settings layer, saving
+	settings swaps in a new one and ``diff`` tells which settings changed.
+	Comma separated lists are parsed into frozensets and the plugs are frozen
+	into tuples of their items, without the currentState the UI keeps in them.
+	"""
+
+	__slots__ = ()
+
+	@classmethod
+	def from_settings(cls, settings):
+		return cls.from_values(dict((key, settings.get([key])) for key in cls._fields))
+
+	@classmethod
+	def from_values(cls, values):
+		return cls(
+			debug_logging=cls._bool(values.get("debug_logging")),
+			abortTimeout=cls._int(values.get("abortTimeout")),
+			powerOffWhenIdle=cls._bool(values.get("powerOffWhenIdle")),
+			idleTimeout=cls._int(values.get("idleTimeout")),
+			idleIgnoreCommands=cls._list(values.get("idleIgnoreCommands"), upper=True),
+			idleIgnoreHeaters=cls._list(values.get("idleIgnoreHeaters")),
+			idleTimeoutWaitTemp=cls._int(values.get("idleTimeoutWaitTemp")),
+			thermal_runaway_monitoring=cls._bool(values.get("thermal_runaway_monitoring")),
+			thermal_runaway_max_bed=cls._int(values.get("thermal_runaway_max_bed")),
+			thermal_runaway_max_extruder=cls._int(values.get("thermal_runaway_max_extruder")),
+			pollingEnabled=cls._bool(values.get("pollingEnabled")),
+			pollingInterval=cls._int(values.get("pollingInterval")),
+			subscriptionsEnabled=cls._bool(values.get("subscriptionsEnabled")),
+			event_on_upload_monitoring=cls._bool(values.get("event_on_upload_monitoring")),
+			event_on_startup_monitoring=cls._bool(values.get("event_on_startup_monitoring")),
+			powerHistoryEnabled=cls._bool(values.get("powerHistoryEnabled")),
+			sharedDevicesEnabled=cls._bool(values.get("sharedDevicesEnabled")),
+			sharedDevicesSocket=(values.get("sharedDevicesSocket") or "").strip(),
+			arrSmartplugs=tuple(tuple(sorted((key, value) for key, value in plug.items() if key != "currentState"))
+								for plug in values.get("arrSmartplugs") or []))
+
+	def diff(self, other):
+		"""Names of the settings that differ between ``other`` and this snapshot."""
+		return frozenset(field for field in self._fields if getattr(self, field) != getattr(other, field))
+
+	@property
+	def plugs(self):
+		return [dict(plug) for plug in self.arrSmartplugs]
+
+	@staticmethod
+	def _bool(value):
+		if isinstance(value, str):
+			return value.lower() in ("true", "yes", "y", "1", "on")
+		return bool(value)
+
+	@staticmethod
+	def _int(value):
+		try:
+			return int(value or 0)
+		except (TypeError, ValueError):
+			return 0
+
+	@staticmethod
+	def _list(value, upper=False):
+		items = (item.strip() for item in (value or "").split(","))
+		return frozenset(item.upper() if upper else item for item in items if item)
 
 
 class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
@@ -75,30 +1319,68 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 					   octoprint.plugin.TemplatePlugin,
 					   octoprint.plugin.SimpleApiPlugin,
 					   octoprint.plugin.StartupPlugin,
+					   octoprint.plugin.ShutdownPlugin,
 					   octoprint.plugin.EventHandlerPlugin):
 
 	def __init__(self):
 		self._logger = logging.getLogger("octoprint.plugins.wemoswitch")
 		self._wemoswitch_logger = logging.getLogger("octoprint.plugins.wemoswitch.debug")
-		self.discovered_devices = []
-		self.abortTimeout = 0
-		self._timeout_value = None
-		self._abort_timer = None
+		self._discovered_devices = []
+		self._discovered_at = None
+		self._discovery_thread = None
+		self._discovery_lock = threading.Lock()
+		self._config = WemoConfig.from_values(self.get_settings_defaults())
+		self._abort_deadline = None
 		self._countdown_active = False
 		self._waitForHeaters = False
 		self._waitForTimelapse = False
 		self._timelapse_active = False
 		self._skipIdleTimer = False
-		self.powerOffWhenIdle = False
-		self._idleTimer = None
-		self.idleTimeout = 30
-		self.idleIgnoreCommands = 'M105'
-		self._idleIgnoreCommandsArray = []
-		self.idleTimeoutWaitTemp = 50
+		self._scheduler = DeadlineScheduler(logger=self._wemoswitch_logger)
+		self._thermal_monitor = LatestValueWorker(self.check_temps, "WemoSwitch Thermal Runaway", logger=self._wemoswitch_logger)
+		self._thermal_runaway_tripped = False
+		self._last_activity = monotonic_time()
+		self._plugs = WemoPlugRegistry()
+		self._gcode_handlers = {"M80": self._gcode_power_on, "M81": self._gcode_power_off}
+		self._device_cache = {}
+		self._device_serials = {}
+		self._device_cache_lock = threading.Lock()
+		self._resolver = HostResolver(logger=self._wemoswitch_logger)
+		self._device_pools = DevicePools()
+		self._plug_health = {}
+		self._plug_health_lock = threading.Lock()
+		self._fan_out = PlugFanOut(logger=self._wemoswitch_logger)
+		# thermal runaway and automatic shutdown never queue behind user commands
+		self._safety_fan_out = PlugFanOut(name="WemoSwitch Safety", logger=self._wemoswitch_logger)
+		self._metrics = PlugMetrics()
+		self._commands = CommandRunner(logger=self._wemoswitch_logger)
+		self._power_off_jobs = collections.OrderedDict()
+		self._power_off_pending = {}
+		self._power_off_lock = threading.Lock()
+		self._pending_print = None
+		self._pending_print_lock = threading.Lock()
+		self._cooldown_pending = False
+		self._cooldown_ignored = frozenset()
+		self._cooldown_lock = threading.Lock()
+		self._plug_states = {}
+		self._plug_states_lock = threading.Lock()
+		self._power_histories = {}
+		self._power_history_lock = threading.Lock()
+		self._poll_timer = None
+		self._subscription_registry = None
+		self._subscribed_devices = {}
+		self._subscription_lock = threading.RLock()
+		# the shared devices role callback restarts polling and subscriptions from its own thread
+		self._monitoring_lock = threading.RLock()
+		self._shared = None
 
 	##~~ StartupPlugin mixin
 
 	def on_startup(self, host, port):
+		self._config = WemoConfig.from_settings(self._settings)
+		self._scheduler.start()
+		self._thermal_monitor.start()
+
 		# setup customized logger
 		from octoprint.logging.handlers import CleaningTimedRotatingFileHandler
 		wemoswitch_logging_handler = CleaningTimedRotatingFileHandler(self._settings.get_plugin_logfile_path(postfix="debug"), when="D", backupCount=3)
@@ -107,87 +1389,148 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 
 		self._wemoswitch_logger.addHandler(wemoswitch_logging_handler)
 		self._wemoswitch_logger.setLevel(
-			logging.DEBUG if self._settings.get_boolean(["debug_logging"]) else logging.INFO)
+			logging.DEBUG if self._config.debug_logging else logging.INFO)
 		self._wemoswitch_logger.propagate = False
 
 	def on_after_startup(self):
 		self._logger.info("WemoSwitch loaded!")
 
-		self.abortTimeout = self._settings.get_int(["abortTimeout"])
-		self._wemoswitch_logger.debug("abortTimeout: %s" % self.abortTimeout)
+		self._wemoswitch_logger.debug("abortTimeout: %s" % self._config.abortTimeout)
+		self._wemoswitch_logger.debug("powerOffWhenIdle: %s" % self._config.powerOffWhenIdle)
+		self._wemoswitch_logger.debug("idleTimeout: %s" % self._config.idleTimeout)
+		self._wemoswitch_logger.debug("idleIgnoreCommands: %s" % ",".join(sorted(self._config.idleIgnoreCommands)))
+		self._wemoswitch_logger.debug("idleTimeoutWaitTemp: %s" % self._config.idleTimeoutWaitTemp)
+		self._build_plug_registry()
+		self._start_shared_devices()
+		if self._config.event_on_startup_monitoring:
+			# don't hold up the rest of the server startup while plugs respond
+			self._scheduler.schedule(0, self._group_command, args=[self.turn_on, self._plugs.event_on_startup_plugs, "startup"], offload=True)
+		self._reset_idle_timer()
+		self._start_subscriptions()
+		self._start_poller()
 
-		self.powerOffWhenIdle = self._settings.get_boolean(["powerOffWhenIdle"])
-		self._wemoswitch_logger.debug("powerOffWhenIdle: %s" % self.powerOffWhenIdle)
+	##~~ ShutdownPlugin mixin
 
-		self.idleTimeout = self._settings.get_int(["idleTimeout"])
-		self._wemoswitch_logger.debug("idleTimeout: %s" % self.idleTimeout)
-		self.idleIgnoreCommands = self._settings.get(["idleIgnoreCommands"])
-		self._idleIgnoreCommandsArray = self.idleIgnoreCommands.split(',')
-		self._wemoswitch_logger.debug("idleIgnoreCommands: %s" % self.idleIgnoreCommands)
-		self.idleTimeoutWaitTemp = self._settings.get_int(["idleTimeoutWaitTemp"])
-		self._wemoswitch_logger.debug("idleTimeoutWaitTemp: %s" % self.idleTimeoutWaitTemp)
-		if self._settings.get_boolean(["event_on_startup_monitoring"]):
-			for plug in self._settings.get(['arrSmartplugs']):
-				if plug["event_on_startup"] is True:
-					self.turn_on(plug["ip"])
-		self._reset_idle_timer()
+	def on_shutdown(self):
+		self._stop_shared_devices()
+		self._scheduler.stop()
+		self._thermal_monitor.stop()
+		self._stop_poller()
+		self._stop_subscriptions()
+		self._fan_out.shutdown()
+		self._safety_fan_out.shutdown()
+		self._device_pools.close()
 
 	##~~ SettingsPlugin mixin
 
-	def get_discovered_device(self, index):
-		tmp_ret = self.discovered_devices[index]
-		return {"label": tmp_ret.name,
-				"ip": "{}:{}".format(tmp_ret.host, tmp_ret.port),
-				"sn": tmp_ret.serial_number}
-
-	def get_discovered_devices(self):
+	def get_discovered_devices(self, force=False):
+		with self._discovery_lock:
+			discovering = self._discovery_thread is not None
+			fresh = self._discovered_at is not None and monotonic_time() - self._discovered_at < DISCOVERY_CACHE_TTL
+			if not discovering and (force or not fresh):
+				# concurrent requests share this one scan
+				self._discovery_thread = threading.Thread(target=self._discover_devices, name="WemoSwitch Discovery")
+				self._discovery_thread.daemon = True
+				self._discovery_thread.start()
+				discovering = True
+			return list(self._discovered_devices), discovering
+
+	def _discover_devices(self):
 		self._wemoswitch_logger.debug("Discovering devices")
-		self.discovered_devices = pywemo.discover_devices()
-		tmp_ret = []
-		for index in range(len(self.discovered_devices)):
-			d = self.get_discovered_device(index)
-			tmp_ret.append(d)
-		return tmp_ret
+		discovered = []
+		try:
+			pywemo = load_pywemo()
+			# scan() only returns once the SSDP timeout is over, after that each device is
+			# reported as soon as its description was fetched
+			for entry in pywemo.ssdp.scan():
+				try:
+					device = pywemo.discovery.device_from_uuid_and_location(entry.udn, entry.location)
+					if device is None:
+						continue
+					d = self._discovered_device_info(device)
+				except Exception:
+					self._wemoswitch_logger.debug("Could not get device info from %s." % entry.location, exc_info=True)
+					continue
+				discovered.append(d)
+				self._plugin_manager.send_plugin_message(self._identifier, dict(type="discovery", discovering=True, device=d))
+		except Exception:
+			self._logger.exception("Error discovering devices")
+		finally:
+			with self._discovery_lock:
+				self._discovered_devices = discovered
+				self._discovered_at = monotonic_time()
+				self._discovery_thread = None
+			self._plugin_manager.send_plugin_message(self._identifier, dict(type="discovery", discovering=False, discovered_devices=discovered))
+
+	def _discovered_device_info(self, device):
+		self._check_device_serial(device.host, device.port, device.serial_number)
+		return {"label": device.name,
+				"ip": "{}:{}".format(device.host, device.port),
+				"sn": device.serial_number}
 
 	def get_settings_defaults(self):
 		return {'debug_logging': False, 'arrSmartplugs': [], 'pollingInterval': 15, 'pollingEnabled': False,
 				'thermal_runaway_monitoring': False, 'thermal_runaway_max_bed': 0, 'thermal_runaway_max_extruder': 0,
 				'abortTimeout': 30, 'powerOffWhenIdle': False, 'idleTimeout': 30, 'idleIgnoreHeaters': '',
 				'idleIgnoreCommands': 'M105', 'idleTimeoutWaitTemp': 50, 'event_on_upload_monitoring': False,
-				'event_on_startup_monitoring': False}
+				'event_on_startup_monitoring': False, 'subscriptionsEnabled': False, 'powerHistoryEnabled': False,
+				'sharedDevicesEnabled': False, 'sharedDevicesSocket': ''}
 
 	def on_settings_save(self, data):
-		old_debug_logging = self._settings.get_boolean(["debug_logging"])
-		old_power_off_when_idle = self._settings.get_boolean(["powerOffWhenIdle"])
-
 		octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
 
-		self.abortTimeout = self._settings.get_int(["abortTimeout"])
-		self.powerOffWhenIdle = self._settings.get_boolean(["powerOffWhenIdle"])
-
-		self.idleTimeout = self._settings.get_int(["idleTimeout"])
-		self.idleIgnoreCommands = self._settings.get(["idleIgnoreCommands"])
-		self._idleIgnoreCommandsArray = self.idleIgnoreCommands.split(',')
-		self.idleTimeoutWaitTemp = self._settings.get_int(["idleTimeoutWaitTemp"])
-
-		if self.powerOffWhenIdle != old_power_off_when_idle:
-			self._plugin_manager.send_plugin_message(self._identifier,
-													 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
-														  timeout_value=self._timeout_value))
-
-		if self.powerOffWhenIdle:
-			self._wemoswitch_logger.debug("Settings saved, Automatic Power Off Enabled, starting idle timer...")
+		old_config, self._config = self._config, WemoConfig.from_settings(self._settings)
+		changed = old_config.diff(self._config)
+		self._wemoswitch_logger.debug("Settings saved, changed: %s" % ", ".join(sorted(changed)))
+		self._apply_config(changed)
+
+	def _apply_config(self, changed):
+		"""Restarts only the parts of the plugin that depend on the ``changed`` settings."""
+		config = self._config
+
+		if "debug_logging" in changed:
+			self._wemoswitch_logger.setLevel(logging.DEBUG if config.debug_logging else logging.INFO)
+
+		plugs_moved = False
+		if "arrSmartplugs" in changed:
+			old_ips = set(self._plugs.ips)
+			self._build_plug_registry()
+			plugs_moved = set(self._plugs.ips) != old_ips
+
+		if plugs_moved:
+			self._invalidate_device()
+			self._reset_health()
+			self._metrics.retain(self._plugs.ips)
+		if plugs_moved or "powerHistoryEnabled" in changed:
+			self._retain_power_histories(self._plugs.ips if config.powerHistoryEnabled else ())
+
+		if changed & set(["thermal_runaway_monitoring", "thermal_runaway_max_bed", "thermal_runaway_max_extruder"]):
+			# re-arm with the new thresholds
+			self._thermal_runaway_tripped = False
+
+		if changed & set(["sharedDevicesEnabled", "sharedDevicesSocket"]):
+			# the role callback restarts polling and subscriptions as needed
+			self._start_shared_devices()
+			if self._shared is None:
+				self._on_shared_role(None)
+		elif plugs_moved and self._shared is not None:
+			self._shared.watch(self._plugs.ips)
+
+		if plugs_moved or "subscriptionsEnabled" in changed:
+			self._start_subscriptions()
+		if changed & set(["pollingEnabled", "pollingInterval", "subscriptionsEnabled"]):
+			self._start_poller()
+		elif plugs_moved:
+			self._poll_missing_states()
+
+		if "powerOffWhenIdle" in changed:
+			self._send_countdown()
+		if changed & set(["powerOffWhenIdle", "idleTimeout"]):
+			self._wemoswitch_logger.debug("Idle settings changed, restarting idle timer.")
 			self._reset_idle_timer()
 
-		new_debug_logging = self._settings.get_boolean(["debug_logging"])
-		if old_debug_logging != new_debug_logging:
-			if new_debug_logging:
-				self._wemoswitch_logger.setLevel(logging.DEBUG)
-			else:
-				self._wemoswitch_logger.setLevel(logging.INFO)
-
 	def get_settings_version(self):
-		return 3
+		return 4
 
 	def on_settings_migrate(self, target, current=None):
 		if current is None or current < 1:
@@ -213,13 +1556,20 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 				plug["event_on_startup"] = False
 				arr_smartplugs_new.append(plug)
 			self._settings.set(["arrSmartplugs"], arr_smartplugs_new)
+		if current in (1, 2, 3):
+			self._logger.debug("Adding new plug settings sysCmdOnTimeout, sysCmdOffTimeout.")
+			arr_smartplugs_new = []
+			for plug in self._settings.get(['arrSmartplugs']):
+				plug["sysCmdOnTimeout"] = 0
+				plug["sysCmdOffTimeout"] = 0
+				arr_smartplugs_new.append(plug)
+			self._settings.set(["arrSmartplugs"], arr_smartplugs_new)
 
 	##~~ AssetPlugin mixin
 
 	def get_assets(self):
-		css = ["css/fontawesome-iconpicker.css",
-			   "css/wemoswitch.css",
-			   ]
+		# the plug editor's scripts and styles are loaded by wemoswitch.js once settings are opened
+		css = ["css/wemoswitch.css"]
 
 		if not is_octoprint_compatible(">=1.5.0"):
 			css += [
@@ -227,8 +1577,7 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 				"css/font-awesome-v4-shims.min.css",
 			]
 
-		return {'js': ["js/jquery-ui.min.js", "js/knockout-sortable.1.2.0.js", "js/fontawesome-iconpicker.js",
-					   "js/ko.iconpicker.js", "js/wemoswitch.js"],
+		return {'js': ["js/wemoswitch.js"],
 				'css': css}
 
 	##~~ TemplatePlugin mixin
@@ -244,52 +1593,126 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 
 	def turn_on(self, plugip):
 		self._wemoswitch_logger.debug("Turning on %s." % plugip)
-		plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
+		plug = self._plugs.get(plugip)
 		self._wemoswitch_logger.debug(plug)
+		if plug is None:
+			self._wemoswitch_logger.debug("%s is not a configured plug." % plugip)
+			return
 		chk = self.sendCommand("on", plugip)
 		if chk == 0:
 			self.check_status(plugip)
-			if plug["autoConnect"]:
-				t = threading.Timer(int(plug["autoConnectDelay"]), self._printer.connect)
-				t.start()
-			if plug["sysCmdOn"]:
-				t = threading.Timer(int(plug["sysCmdOnDelay"]), os.system, args=[plug["sysRunCmdOn"]])
-				t.start()
+			if plug.autoConnect:
+				self._scheduler.schedule(plug.autoConnectDelay, self._printer.connect, offload=True)
+			if plug.sysCmdOn:
+				self._schedule_command(plug, "on", plug.sysCmdOnDelay, plug.sysRunCmdOn, plug.sysCmdOnTimeout)
 			self._reset_idle_timer()
 			return "on"
 
 	def turn_off(self, plugip):
+		"""
+		Starts the power off sequence of a plug and returns its job id right
+		away, completion is sent as a power_off plugin message.
+		"""
 		self._wemoswitch_logger.debug("Turning off %s." % plugip)
-		plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
+		plug = self._plugs.get(plugip)
 		self._wemoswitch_logger.debug(plug)
-		if plug["sysCmdOff"]:
-			t = threading.Timer(int(plug["sysCmdOffDelay"]), os.system, args=[plug["sysRunCmdOff"]])
-			t.start()
-		if plug["autoDisconnect"]:
+		if plug is None:
+			self._wemoswitch_logger.debug("%s is not a configured plug." % plugip)
+			return
+
+		with self._power_off_lock:
+			job = self._power_off_pending.get(plugip)
+			if job is not None:
+				self._wemoswitch_logger.debug("Power off of %s already running as %s." % (plugip, job.id))
+				return job.id
+			job = self._power_off_pending[plugip] = PowerOffJob(plugip)
+			self._power_off_jobs[job.id] = job
+			while len(self._power_off_jobs) > POWER_OFF_JOB_HISTORY:
+				self._power_off_jobs.popitem(last=False)
+
+		if plug.sysCmdOff:
+			self._schedule_command(plug, "off", plug.sysCmdOffDelay, plug.sysRunCmdOff, plug.sysCmdOffTimeout)
+		if plug.autoDisconnect:
+			self._scheduler.schedule(0, self._power_off_disconnect, args=[job, plug], offload=True)
+		else:
+			self._scheduler.schedule(0, self._power_off_send, args=[job], offload=True)
+		return job.id
+
+	def _power_off_disconnect(self, job, plug):
+		try:
 			self._printer.disconnect()
-			time.sleep(int(plug["autoDisconnectDelay"]))
-		chk = self.sendCommand("off", plugip)
-		if chk == 0:
-			self.check_status(plugip)
+		finally:
+			self._scheduler.schedule(plug.autoDisconnectDelay, self._power_off_send, args=[job], offload=True)
 
-	def check_status(self, plugip):
+	def _power_off_send(self, job):
+		chk = 3
+		try:
+			chk = self.sendCommand("off", job.ip)
+			if chk == 0:
+				self.check_status(job.ip)
+		finally:
+			self._finish_power_off(job, chk == 0)
+
+	def _finish_power_off(self, job, success):
+		with self._plug_states_lock:
+			state = self._plug_states.get(job.ip, "unknown")
+		with self._power_off_lock:
+			if self._power_off_pending.get(job.ip) is job:
+				del self._power_off_pending[job.ip]
+		job.finish(success, state)
+		self._wemoswitch_logger.debug("Power off job %s for %s %s." % (job.id, job.ip, job.status))
+		self._plugin_manager.send_plugin_message(self._identifier, dict(job.to_dict(), type="power_off"))
+
+	def _schedule_command(self, plug, action, delay, command, timeout):
+		# toggling again within the delay replaces the pending run instead of adding another
+		self._scheduler.schedule(delay, self._run_command, args=[plug.ip, action, command, timeout],
+								 name="command %s %s" % (action, plug.ip), offload=True)
+
+	def _run_command(self, plugip, action, command, timeout):
+		run = self._commands.run(plugip, action, command, timeout=timeout)
+		if run is not None:
+			self._metrics.observe(plugip, "command_%s" % action, run.duration, error=run.status != "done")
+
+	def _start_power_off(self, plugip):
+		job_id = self.turn_off(plugip)
+		with self._power_off_lock:
+			job = self._power_off_jobs.get(job_id)
+		return job.to_dict() if job is not None else None
+
+	def _turn_off_and_wait(self, plugip):
+		"""Runs the power off sequence and blocks until it finished, for pool threads only."""
+		job_id = self.turn_off(plugip)
+		if job_id is None:
+			return None
+		with self._power_off_lock:
+			job = self._power_off_jobs[job_id]
+		plug = self._plugs.get(plugip)
+		delay = plug.autoDisconnectDelay if plug is not None and plug.autoDisconnect else 0
+		if not job.wait(delay + POWER_OFF_WAIT_TIMEOUT):
+			self._wemoswitch_logger.debug("Power off job %s for %s is taking too long." % (job_id, plugip))
+		return job.to_dict()
+
+	def check_status(self, plugip, force=True):
 		self._wemoswitch_logger.debug("Checking status of %s." % plugip)
 		if plugip != "":
 			chk = self.sendCommand("info", plugip)
-			if chk == 1:
-				self._plugin_manager.send_plugin_message(self._identifier, dict(currentState="on", ip=plugip))
-			elif chk == 8:
-				self._plugin_manager.send_plugin_message(self._identifier, dict(currentState="on", ip=plugip))
-			elif chk == 0:
-				self._plugin_manager.send_plugin_message(self._identifier, dict(currentState="off", ip=plugip))
-			else:
+			if chk not in (0, 1, 8):
 				self._wemoswitch_logger.debug(chk)
-				self._plugin_manager.send_plugin_message(self._identifier, dict(currentState="unknown", ip=plugip))
+			self._update_plug_state(plugip, self._state_name(chk), force)
+
+	@staticmethod
+	def _state_name(chk):
+		if chk in (1, 8):
+			return "on"
+		if chk == 0:
+			return "off"
+		return "unknown"
 
 	def get_api_commands(self):
 		return dict(turnOn=["ip"],
 					turnOff=["ip"],
 					checkStatus=["ip"],
+					batch=["ips", "action"],
 					enableAutomaticShutdown=[],
 					disableAutomaticShutdown=[],
 					abortAutomaticShutdown=[])
@@ -298,8 +1721,63 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 		if not Permissions.PLUGIN_WEMOSWITCH_CONTROL.can():
 			return flask.make_response("Insufficient rights", 403)
 
+		if request.args.get("resolver"):
+			return flask.jsonify(self._resolver.stats())
+
+		if request.args.get("health"):
+			return flask.jsonify(self._health_stats())
+
+		if request.args.get("pools"):
+			return flask.jsonify(self._device_pools.stats())
+
+		if request.args.get("metrics") == "prometheus":
+			return flask.Response(self._metrics.to_prometheus(), mimetype="text/plain; version=0.0.4")
+
+		if request.args.get("metrics"):
+			return flask.jsonify(self._metrics.to_dict())
+
+		if request.args.get("job"):
+			with self._power_off_lock:
+				job = self._power_off_jobs.get(request.args.get("job"))
+			if job is None:
+				return flask.make_response("Unknown job", 404)
+			return flask.jsonify(job.to_dict())
+
+		if request.args.get("command"):
+			run = self._commands.get(request.args.get("command"))
+			if run is None:
+				return flask.make_response("Unknown command", 404)
+			return flask.jsonify(run.to_dict())
+
+		if request.args.get("commands"):
+			return flask.jsonify(dict(commands=[run.to_dict() for run in self._commands.runs()]))
+
+		if request.args.get("power"):
+			with self._power_history_lock:
+				history = self._power_histories.get(request.args.get("power"))
+			if history is None:
+				return flask.make_response("No power history for this plug", 404)
+			try:
+				end = float(request.args.get("end", time.time()))
+				start = float(request.args.get("start", end - 3600))
+			except ValueError:
+				return flask.make_response("Invalid time range", 400)
+			tier = request.args.get("tier")
+			if tier is not None and tier not in [name for name, width, size in PowerHistory.tiers]:
+				return flask.make_response("Unknown tier", 400)
+			tier, points = history.query(start, end, tier)
+			return flask.jsonify(dict(ip=request.args.get("power"), tier=tier, start=start, end=end,
+									  latest=history.latest, points=points))
+
+		if request.args.get("states"):
+			# served from the cache, never touches the devices
+			with self._plug_states_lock:
+				states = dict(self._plug_states)
+			return flask.jsonify(dict(states=states))
+
 		if request.args.get("discover_devices"):
-			return flask.jsonify({"discovered_devices": self.get_discovered_devices()})
+			discovered_devices, discovering = self.get_discovered_devices(force=bool(request.args.get("refresh")))
+			return flask.jsonify({"discovered_devices": discovered_devices, "discovering": discovering})
 
 	def on_api_command(self, command, data):
 		if not Permissions.PLUGIN_WEMOSWITCH_CONTROL.can():
@@ -308,113 +1786,411 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 		if command == 'turnOn':
 			self.turn_on("{ip}".format(**data))
 		elif command == 'turnOff':
-			self.turn_off("{ip}".format(**data))
+			return flask.jsonify(dict(job_id=self.turn_off("{ip}".format(**data))))
 		elif command == 'checkStatus':
 			self.check_status("{ip}".format(**data))
+		elif command == 'batch':
+			return self._batch_command(data)
 		elif command == 'enableAutomaticShutdown':
 			self._wemoswitch_logger.debug("enabling automatic power off on idle")
-			self.powerOffWhenIdle = True
+			self._config = self._config._replace(powerOffWhenIdle=True)
 			self._reset_idle_timer()
 			self._settings.set_boolean(["powerOffWhenIdle"], True)
 			self._settings.save(trigger_event=True)
-			return flask.jsonify(dict(powerOffWhenIdle=self.powerOffWhenIdle))
+			return flask.jsonify(dict(powerOffWhenIdle=self._config.powerOffWhenIdle))
 		elif command == 'disableAutomaticShutdown':
 			self._wemoswitch_logger.debug("disabling automatic power off on idle")
-			self.powerOffWhenIdle = False
+			self._config = self._config._replace(powerOffWhenIdle=False)
 			self._stop_idle_timer()
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-			self._timeout_value = None
+			if self._scheduler.cancel("abort"):
+				self._metrics.count("abort_countdown_cancelled")
+			self._abort_deadline = None
+			self._send_countdown()
 			self._settings.set_boolean(["powerOffWhenIdle"], False)
 			self._settings.save(trigger_event=True)
-			return flask.jsonify(dict(powerOffWhenIdle=self.powerOffWhenIdle))
+			return flask.jsonify(dict(powerOffWhenIdle=self._config.powerOffWhenIdle))
 		elif command == 'abortAutomaticShutdown':
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-			self._timeout_value = None
+			if self._scheduler.cancel("abort"):
+				self._metrics.count("abort_countdown_cancelled")
+			self._abort_deadline = None
+			self._send_countdown()
 			self._wemoswitch_logger.debug("Power off aborted.")
 			self._wemoswitch_logger.debug("Restarting idle timer.")
 			self._reset_idle_timer()
 
+	def _batch_command(self, data):
+		# power offs only get started here, their jobs can be followed like the single turnOff
+		actions = dict(turnOn=self.turn_on, turnOff=self._start_power_off, checkStatus=self.check_status)
+		function = actions.get(data["action"])
+		if function is None:
+			return flask.make_response("Unknown action %s" % data["action"], 400)
+		if not isinstance(data["ips"], list):
+			return flask.make_response("ips must be a list", 400)
+
+		plugips = [plugip for plugip in data["ips"] if self._plugs.get(plugip) is not None]
+		results, elapsed = self._fan_out.run(plugips, function)
+		with self._plug_states_lock:
+			for plugip, outcome in results.items():
+				result = outcome.pop("result")
+				outcome["state"] = self._plug_states.get(plugip, "unknown")
+				if outcome["error"] is not None:
+					continue
+				if data["action"] == "turnOn" and result != "on":
+					outcome["error"] = "Could not turn on"
+				elif data["action"] == "turnOff":
+					if result is None:
+						outcome["error"] = "Could not start power off"
+					else:
+						outcome["job_id"] = result["job_id"]
+						outcome["status"] = result["status"]
+						if result["status"] == "failed":
+							outcome["error"] = "Power off failed"
+				elif data["action"] == "checkStatus" and outcome["state"] == "unknown":
+					outcome["error"] = "Could not get state"
+		for plugip in data["ips"]:
+			if plugip not in results:
+				results[plugip] = dict(error="Unknown plug", elapsed=0, state="unknown")
+		self._wemoswitch_logger.debug("Batch %s of %s plugs took %.2fs." % (data["action"], len(results), elapsed))
+		return flask.jsonify(dict(action=data["action"], elapsed=elapsed, results=results))
+
 	##~~ EventHandlerPlugin mixin
 
 	def on_event(self, event, payload):
 		# Client Opened Event
 		if event == Events.CLIENT_OPENED:
-			if self._settings.get_boolean(["powerOffWhenIdle"]):
+			if self._config.powerOffWhenIdle:
 				self._reset_idle_timer()
-			self._plugin_manager.send_plugin_message(self._identifier, dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout", timeout_value=self._timeout_value))
+			self._send_countdown()
+			with self._plug_states_lock:
+				states = dict(self._plug_states)
+			self._plugin_manager.send_plugin_message(self._identifier, dict(type="states", states=states))
+			if self._config.powerHistoryEnabled:
+				self._plugin_manager.send_plugin_message(self._identifier, dict(type="power", plugs=self._power_overview()))
 			return
 		# Print Started Event
-		if event == Events.PRINT_STARTED and self.powerOffWhenIdle is True:
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-				self._tplinksmartplug_logger.debug("Power off aborted because starting new print.")
-			if self._idleTimer is not None:
+		if event == Events.PRINT_STARTED and self._config.powerOffWhenIdle is True:
+			if self._scheduler.cancel("abort"):
+				self._metrics.count("abort_countdown_cancelled")
+				self._wemoswitch_logger.debug("Power off aborted because starting new print.")
+			if self._scheduler.is_scheduled("idle"):
 				self._reset_idle_timer()
-			self._timeout_value = None
-			self._plugin_manager.send_plugin_message(self._identifier, dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout", timeout_value=self._timeout_value))
+			self._abort_deadline = None
+			self._send_countdown()
 		# Cancelled Print Interpreted Event
-		if event == Events.PRINT_FAILED and not self._printer.is_closed_or_error() and self.powerOffWhenIdle is True:
+		if event == Events.PRINT_FAILED and not self._printer.is_closed_or_error() and self._config.powerOffWhenIdle is True:
 			self._reset_idle_timer()
 		# Print Done Event
-		if event == Events.PRINT_DONE and self.powerOffWhenIdle is True:
+		if event == Events.PRINT_DONE and self._config.powerOffWhenIdle is True:
 			self._reset_idle_timer()
 		# Timelapse Events
-		if self.powerOffWhenIdle is True and event == Events.MOVIE_RENDERING:
+		if self._config.powerOffWhenIdle is True and event == Events.MOVIE_RENDERING:
 			self._wemoswitch_logger.debug("Timelapse generation started: %s" % payload.get("movie_basename", ""))
 			self._timelapse_active = True
 
 		if self._timelapse_active and event == Events.MOVIE_DONE or event == Events.MOVIE_FAILED:
 			self._wemoswitch_logger.debug("Timelapse generation finished: %s. Return Code: %s" % (payload.get("movie_basename", ""), payload.get("returncode", "completed")))
 			self._timelapse_active = False
+			self._timelapse_finished()
+
+		# no more temperature reports once disconnected, settle a pending cooldown with what is known
+		if event == Events.DISCONNECTED and self._cooldown_pending:
+			self._check_cooldown(self._current_tool_temps())
 
 		# File Uploaded Event
-		if event == Events.UPLOAD and self._settings.get_boolean(["event_on_upload_monitoring"]):
+		if event == Events.UPLOAD and self._config.event_on_upload_monitoring:
 			if payload.get("print", False): # implemented in OctoPrint version 1.4.1
 				self._wemoswitch_logger.debug("File uploaded: %s. Turning enabled plugs on." % payload.get("name", ""))
 				self._wemoswitch_logger.debug(payload)
-				for plug in self._settings.get(['arrSmartplugs']):
-					self._wemoswitch_logger.debug(plug)
-					if plug["event_on_upload"] is True and not self._printer.is_ready():
-						self._wemoswitch_logger.debug("powering on %s due to %s event." % (plug["ip"], event))
-						response = self.turn_on(plug["ip"])
-						if response == "on":
-							self._wemoswitch_logger.debug("power on successful for %s attempting connection in %s seconds" % (plug["ip"], plug.get("autoConnectDelay", "0")))
-							if payload.get("path", False) is not False and payload.get("target") == "local":
-								time.sleep(int(plug.get("autoConnectDelay", "0"))+1)
-								if self._printer.is_ready():
-									self._wemoswitch_logger.debug("printer connected starting print of %s" % (payload.get("path", "")))
-									self._printer.select_file(payload.get("path"), False, printAfterSelect=True)
+				if not self._printer.is_ready():
+					path = None
+					if payload.get("path", False) is not False and payload.get("target") == "local":
+						path = payload.get("path")
+					self._scheduler.schedule(0, self._upload_power_on, args=[path], offload=True)
+
+		# Printer Connected Events
+		if event in (Events.CONNECTED, Events.PRINTER_STATE_CHANGED) and self._pending_print is not None:
+			self._start_pending_print()
+
+	##~~ Print After Upload
+
+	def _upload_power_on(self, path):
+		plugs = self._plugs.event_on_upload_plugs
+		if path is not None and plugs:
+			# armed before powering on so a quick connection isn't missed
+			self._set_pending_print(path, max(plug.autoConnectDelay for plug in plugs) + UPLOAD_PRINT_TIMEOUT)
+
+		results = self._group_command(self.turn_on, plugs, Events.UPLOAD)
+		powered_on = sorted(plugip for plugip, outcome in results.items() if outcome["result"] == "on")
+		if path is None:
+			return
+		if not powered_on:
+			self._wemoswitch_logger.debug("No plugs powered on, not printing %s." % path)
+			self._clear_pending_print()
+			return
+
+		self._wemoswitch_logger.debug("power on successful for %s, printing %s once the printer is connected" % (", ".join(powered_on), path))
+		self._start_pending_print()
+
+	def _set_pending_print(self, path, timeout):
+		with self._pending_print_lock:
+			self._pending_print = path
+		self._scheduler.schedule(timeout, self._expire_pending_print, args=[timeout], name="upload_print")
+
+	def _clear_pending_print(self):
+		with self._pending_print_lock:
+			self._pending_print = None
+		self._scheduler.cancel("upload_print")
+
+	def _expire_pending_print(self, timeout):
+		with self._pending_print_lock:
+			path, self._pending_print = self._pending_print, None
+		if path is not None:
+			self._wemoswitch_logger.debug("Printer not connected after %ss, not printing %s." % (timeout, path))
+
+	def _start_pending_print(self):
+		with self._pending_print_lock:
+			if self._pending_print is None or not self._printer.is_ready():
+				return
+			path, self._pending_print = self._pending_print, None
+		self._scheduler.cancel("upload_print")
+		self._wemoswitch_logger.debug("printer connected starting print of %s" % path)
+		self._printer.select_file(path, False, printAfterSelect=True)
+
+	##~~ Status Polling
+
+	def _start_poller(self):
+		with self._monitoring_lock:
+			self._stop_poller()
+
+			if self._is_shared_client():
+				# the owning instance polls and pushes every change
+				return
+
+			# with event subscriptions active polling only runs as a fallback for plugs that aren't subscribed
+			if self._config.pollingEnabled or self._config.subscriptionsEnabled:
+				interval = max(self._config.pollingInterval, 1) * 60
+				self._wemoswitch_logger.debug("Polling plug status every %s seconds." % interval)
+				self._poll_timer = RepeatedTimer(interval, self._poll_statuses, run_first=True)
+				self._poll_timer.start()
+			else:
+				# still learn the initial state once so connecting clients get a snapshot
+				t = threading.Thread(target=self._poll_statuses)
+				t.daemon = True
+				t.start()
+
+	def _stop_poller(self):
+		with self._monitoring_lock:
+			if self._poll_timer is not None:
+				self._poll_timer.cancel()
+				self._poll_timer = None
+
+	def _poll_statuses(self):
+		plug_ips = self._polled_ips()
+		with self._plug_states_lock:
+			for plugip in list(self._plug_states.keys()):
+				if plugip not in plug_ips:
+					del self._plug_states[plugip]
+		self._check_statuses(plug_ips)
+
+	def _check_statuses(self, plug_ips):
+		for plugip in plug_ips:
+			if self._is_subscribed(plugip):
+				continue
+			self.check_status(plugip, force=False)
+
+	def _poll_missing_states(self):
+		with self._plug_states_lock:
+			known = set(self._plug_states.keys())
+		missing = [plugip for plugip in self._polled_ips() if plugip not in known]
+		if missing:
+			t = threading.Thread(target=self._check_statuses, args=[missing])
+			t.daemon = True
+			t.start()
+
+	def _polled_ips(self):
+		# the owner of shared devices keeps the other instances' plugs up to date as well
+		shared = self._shared
+		if shared is not None and shared.role == SharedDevices.OWNER:
+			own = set(self._plugs.ips)
+			return self._plugs.ips + tuple(sorted(plugip for plugip in shared.watched() if plugip not in own))
+		return self._plugs.ips
+
+	def _update_plug_state(self, plugip, state, force=False):
+		with self._plug_states_lock:
+			changed = self._plug_states.get(plugip) != state
+			self._plug_states[plugip] = state
+		if changed and self._shared is not None:
+			self._shared.broadcast(plugip, state)
+		if changed or force:
+			self._plugin_manager.send_plugin_message(self._identifier, dict(currentState=state, ip=plugip))
+
+	##~~ UPnP Event Subscriptions
+
+	def _start_subscriptions(self):
+		with self._monitoring_lock:
+			self._stop_subscriptions()
+
+			if not self._config.subscriptionsEnabled or self._is_shared_client():
+				return
+
+			pywemo = load_pywemo()
+			registry = pywemo.SubscriptionRegistry()
+			try:
+				registry.start()
+			except pywemo.PyWeMoException as e:
+				self._logger.warning("Could not start event subscriptions, falling back to polling: %s" % e)
+				return
+
+			with self._subscription_lock:
+				self._subscription_registry = registry
+			t = threading.Thread(target=self._subscribe_plugs)
+			t.daemon = True
+			t.start()
+
+	def _stop_subscriptions(self):
+		with self._monitoring_lock:
+			with self._subscription_lock:
+				registry = self._subscription_registry
+				self._subscription_registry = None
+				self._subscribed_devices = {}
+			if registry is not None:
+				registry.stop()
+
+	def _subscribe_plugs(self):
+		for plugip in self._polled_ips():
+			device = self._get_device(plugip)
+			if device is not None:
+				self._subscribe_plug(plugip, device)
+
+	def _subscribe_plug(self, plugip, device):
+		with self._subscription_lock:
+			registry = self._subscription_registry
+			if registry is None:
+				return
+			old_device = self._subscribed_devices.get(plugip)
+			if old_device is device:
+				return
+			if old_device is not None:
+				registry.unregister(old_device)
+			self._wemoswitch_logger.debug("Subscribing to events from %s." % plugip)
+			registry.register(device)
+			registry.on(device, "BinaryState", functools.partial(self._on_subscription_event, plugip))
+			if hasattr(device, "insight_params"):
+				registry.on(device, "InsightParams", functools.partial(self._on_insight_event, plugip))
+			self._subscribed_devices[plugip] = device
+
+	def _is_subscribed(self, plugip):
+		with self._subscription_lock:
+			registry = self._subscription_registry
+			device = self._subscribed_devices.get(plugip)
+			if registry is None or device is None:
+				return False
+			return registry.is_subscribed(device)
+
+	def _on_subscription_event(self, plugip, device, event_type, value):
+		self._wemoswitch_logger.debug("Received %s event %s from %s." % (event_type, value, plugip))
+		state = value.split("|")[0]
+		if state in ("1", "8"):
+			self._update_plug_state(plugip, "on")
+		elif state == "0":
+			self._update_plug_state(plugip, "off")
+		else:
+			self._update_plug_state(plugip, "unknown")
+
+	##~~ Shared Devices
+
+	def _start_shared_devices(self):
+		self._stop_shared_devices()
+		if not self._config.sharedDevicesEnabled:
+			return
+		if not hasattr(socket, "AF_UNIX"):
+			self._logger.warning("Sharing plugs with other instances needs Unix sockets, which aren't available here.")
+			return
+
+		try:
+			path = self._config.sharedDevicesSocket or SharedDevices.default_path()
+		except OSError as e:
+			self._logger.warning("Could not create the directory for sharing plugs: %r" % e)
+			return
+
+		shared = SharedDevices(path, self._shared_command, self._known_states,
+							   self._on_shared_state, self._on_shared_role, on_watch=self._on_shared_watch,
+							   logger=self._wemoswitch_logger)
+		shared.watch(self._plugs.ips)
+		self._shared = shared
+		shared.start()
+
+	def _stop_shared_devices(self):
+		shared, self._shared = self._shared, None
+		if shared is not None:
+			shared.stop()
+
+	def _is_shared_client(self):
+		shared = self._shared
+		return shared is not None and shared.role == SharedDevices.CLIENT
+
+	def _shared_command(self, cmd, plugip):
+		# runs on the owner for another instance, state reads are shared with everyone watching the plug
+		chk = self._device_command(cmd, plugip)
+		if cmd == "info":
+			self._update_plug_state(plugip, self._state_name(chk))
+		return chk
+
+	def _known_states(self, plugips):
+		with self._plug_states_lock:
+			return dict((plugip, self._plug_states[plugip]) for plugip in plugips if plugip in self._plug_states)
+
+	def _on_shared_watch(self, plugips):
+		self._poll_missing_states()
+
+	def _on_shared_state(self, plugip, state):
+		if self._plugs.get(plugip) is not None:
+			self._update_plug_state(plugip, state)
+
+	def _on_shared_role(self, role):
+		self._wemoswitch_logger.debug("Shared devices role is now %s." % role)
+		# owners and standalone instances talk to the plugs themselves, clients leave that to the owner
+		self._start_subscriptions()
+		self._start_poller()
 
 	##~~ Idle Timeout
 
 	def _start_idle_timer(self):
-		self._stop_idle_timer()
+		self._last_activity = monotonic_time()
 
-		if self.powerOffWhenIdle:
-			self._idleTimer = ResettableTimer(self.idleTimeout * 60, self._idle_poweroff)
-			self._idleTimer.start()
+		if self._config.powerOffWhenIdle:
+			self._metrics.count("idle_timer_started")
+			self._scheduler.schedule(self._config.idleTimeout * 60, self._idle_check, name="idle")
+		else:
+			self._stop_idle_timer()
 
 	def _stop_idle_timer(self):
-		if self._idleTimer:
-			self._idleTimer.cancel()
-			self._idleTimer = None
+		self._scheduler.cancel("idle")
 
 	def _reset_idle_timer(self):
-		try:
-			if self._idleTimer.is_alive():
-				self._idleTimer.reset()
-			else:
-				raise Exception()
-		except:
+		self._start_idle_timer()
+
+	def _idle_check(self):
+		if not self._config.powerOffWhenIdle:
+			return
+
+		# queued gcode only records activity, so the deadline may have moved since this was scheduled
+		deadline = self._last_activity + self._config.idleTimeout * 60
+		if deadline > monotonic_time():
+			self._scheduler.schedule_at(deadline, self._idle_check, name="idle")
+			return
+
+		# reading temperatures and turning off heaters talks to the printer, keep that off the scheduler thread
+		self._scheduler.schedule(0, self._run_idle_poweroff, offload=True)
+
+	def _run_idle_poweroff(self):
+		self._idle_poweroff()
+		if self._config.powerOffWhenIdle and not self._scheduler.is_scheduled("idle") and not self._scheduler.is_scheduled("abort"):
+			# keep watching for idle periods until the abort countdown takes over
 			self._start_idle_timer()
 
 	def _idle_poweroff(self):
-		if not self.powerOffWhenIdle:
+		if not self._config.powerOffWhenIdle:
 			return
 
 		if self._waitForHeaters:
@@ -426,47 +2202,46 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 		if self._printer.is_printing() or self._printer.is_paused():
 			return
 
-		if (uptime() / 60) <= (self._settings.get_int(["idleTimeout"])):
+		from uptime import uptime
+		if (uptime() / 60) <= self._config.idleTimeout:
 			self._wemoswitch_logger.debug("Just booted so wait for time sync.")
-			self._wemoswitch_logger.debug("uptime: {}, comparison: {}".format((uptime() / 60), (self._settings.get_int(["idleTimeout"]))))
+			self._wemoswitch_logger.debug("uptime: {}, comparison: {}".format((uptime() / 60), self._config.idleTimeout))
 			self._reset_idle_timer()
 			return
 
-		self._wemoswitch_logger.debug("Idle timeout reached after %s minute(s). Waiting for hot end to cool prior to powering off plugs." % self.idleTimeout)
-		if self._wait_for_heaters():
-			self._wemoswitch_logger.debug("Heaters below temperature.")
-			if self._wait_for_timelapse():
-				self._timer_start()
-		else:
-			self._wemoswitch_logger.debug("Aborted power off due to activity.")
+		self._metrics.count("idle_timeout_reached")
+		self._wemoswitch_logger.debug("Idle timeout reached after %s minute(s). Waiting for hot end to cool prior to powering off plugs." % self._config.idleTimeout)
+		self._start_cooldown()
 
 	##~~ Timelapse Monitoring
 
 	def _wait_for_timelapse(self):
-		self._waitForTimelapse = True
-		self._wemoswitch_logger.debug("Checking timelapse status before shutting off power...")
+		if not self._timelapse_active:
+			self._timer_start()
+			return
 
-		while True:
-			if not self._waitForTimelapse:
-				return False
+		self._waitForTimelapse = True
+		self._wemoswitch_logger.debug("Waiting for timelapse before shutting off power...")
 
-			if not self._timelapse_active:
-				self._waitForTimelapse = False
-				return True
+	def _timelapse_finished(self):
+		if not self._waitForTimelapse:
+			return
 
-			self._wemoswitch_logger.debug("Waiting for timelapse before shutting off power...")
-			time.sleep(5)
+		self._waitForTimelapse = False
+		if self._config.powerOffWhenIdle and not self._printer.is_printing():
+			self._timer_start()
 
 	##~~ Temperature Cooldown
 
-	def _wait_for_heaters(self):
+	def _start_cooldown(self):
+		# the ignored heaters are fixed for the whole cooldown, even if settings change meanwhile
+		self._cooldown_ignored = self._config.idleIgnoreHeaters
 		self._waitForHeaters = True
 		heaters = self._printer.get_current_temperatures()
-		ignored_heaters = self._settings.get(["idleIgnoreHeaters"]).split(",")
 
 		for heater, entry in heaters.items():
 			target = entry.get("target")
-			if target is None or heater in ignored_heaters:
+			if target is None or heater in self._cooldown_ignored:
 				# heater doesn't exist in fw
 				continue
 
@@ -484,123 +2259,308 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 			else:
 				self._wemoswitch_logger.debug("Heater %s already off." % heater)
 
-		while True:
-			if not self._waitForHeaters:
-				return False
-
-			heaters = self._printer.get_current_temperatures()
-
-			highest_temp = 0
-			heaters_above_waittemp = []
-			for heater, entry in heaters.items():
-				if not heater.startswith("tool") or heater in ignored_heaters:
-					continue
-
-				actual = entry.get("actual")
-				if actual is None:
-					# heater doesn't exist in fw
-					continue
-
-				try:
-					temp = float(actual)
-				except ValueError:
-					# not a float for some reason, skip it
-					continue
-
-				self._wemoswitch_logger.debug("Heater %s = %sC" % (heater, temp))
-				if temp > self.idleTimeoutWaitTemp:
-					heaters_above_waittemp.append(heater)
-
-				if temp > highest_temp:
-					highest_temp = temp
+		# from here on the temperature hook drives the cooldown
+		with self._cooldown_lock:
+			self._cooldown_pending = True
+		hot = self._check_cooldown(self._current_tool_temps())
+		if hot:
+			self._wemoswitch_logger.debug("Waiting for heaters(%s) before shutting power off..." % ', '.join(hot))
 
-			if highest_temp <= self.idleTimeoutWaitTemp:
+	def _current_tool_temps(self):
+		temps = {}
+		for heater, entry in self._printer.get_current_temperatures().items():
+			try:
+				temps[heater] = float(entry.get("actual"))
+			except (TypeError, ValueError):
+				# heater doesn't exist in fw or not a float for some reason, skip it
+				continue
+		return temps
+
+	@staticmethod
+	def _parsed_tool_temps(parsed_temps):
+		# the temperature hook reports T0, T1, ... for what OctoPrint calls tool0, tool1, ...
+		return dict(("tool" + (k[1:] or "0"), v[0]) for k, v in parsed_temps.items() if k.startswith("T"))
+
+	def _check_cooldown(self, temps):
+		"""Returns the tools still above idleTimeoutWaitTemp, moves on to the timelapse check once there are none."""
+		with self._cooldown_lock:
+			if not self._cooldown_pending:
+				return []
+			aborted = not self._waitForHeaters
+			if not aborted:
+				hot = sorted(heater for heater, actual in temps.items()
+							 if heater.startswith("tool") and heater not in self._cooldown_ignored
+							 and actual is not None and actual > self._config.idleTimeoutWaitTemp)
+				if hot:
+					return hot
 				self._waitForHeaters = False
-				return True
+			self._cooldown_pending = False
+
+		if aborted:
+			self._metrics.count("idle_poweroff_aborted")
+			self._wemoswitch_logger.debug("Aborted power off due to activity.")
+			return []
 
-			self._wemoswitch_logger.debug("Waiting for heaters(%s) before shutting power off..." % ', '.join(heaters_above_waittemp))
-			time.sleep(5)
+		self._wemoswitch_logger.debug("Heaters below temperature.")
+		self._wait_for_timelapse()
+		return []
 
 	##~~ Abort Power Off Timer
 
 	def _timer_start(self):
-		if self._abort_timer is not None:
+		if self._scheduler.is_scheduled("abort"):
 			return
 
 		self._wemoswitch_logger.debug("Starting abort power off timer.")
+		self._metrics.count("abort_countdown_started")
+		self._stop_idle_timer()
 
-		self._timeout_value = self.abortTimeout
-		self._abort_timer = RepeatedTimer(1, self._timer_task)
-		self._abort_timer.start()
+		# clients count down to the deadline themselves, there's no message per second
+		self._abort_deadline = time.time() + self._config.abortTimeout
+		self._scheduler.schedule(self._config.abortTimeout, self._timer_task, name="abort")
+		self._send_countdown()
 
 	def _timer_task(self):
-		if self._timeout_value is None:
+		if self._abort_deadline is None:
 			return
 
-		self._timeout_value -= 1
-		self._plugin_manager.send_plugin_message(self._identifier, dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout", timeout_value=self._timeout_value))
-		if self._timeout_value <= 0:
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-			self._shutdown_system()
+		self._abort_deadline = None
+		self._metrics.count("abort_countdown_completed")
+		self._scheduler.schedule(0, self._shutdown_system, offload=True)
+
+	def _send_countdown(self):
+		deadline = self._abort_deadline
+		timeout_value = None
+		if deadline is not None:
+			timeout_value = max(int(math.ceil(deadline - time.time())), 0)
+		self._plugin_manager.send_plugin_message(self._identifier, dict(powerOffWhenIdle=self._config.powerOffWhenIdle, type="timeout",
+																		timeout_value=timeout_value))
 
 	def _shutdown_system(self):
 		self._wemoswitch_logger.debug("Automatically powering off enabled plugs.")
-		for plug in self._settings.get(['arrSmartplugs']):
-			if plug.get("automaticShutdownEnabled", False):
-				self.turn_off("{ip}".format(**plug))
+		# plugs guarding against thermal runaway feed the heaters, get those off first
+		critical = set(plug.ip for plug in self._plugs.thermal_runaway_plugs)
+		self._group_command(self._turn_off_and_wait, self._plugs.automatic_shutdown_plugs, "automatic shutdown",
+							critical=critical, fan_out=self._safety_fan_out)
 
-	##~~ Utilities
+	def _group_command(self, function, plugs, reason, critical=(), fan_out=None):
+		fan_out = fan_out if fan_out is not None else self._fan_out
+		results, elapsed = fan_out.run([plug.ip for plug in plugs], function, critical=critical)
+		self._wemoswitch_logger.debug("%s of %s plugs for %s took %.2fs: %s" % (function.__name__, len(results), reason, elapsed, results))
+		return results
 
-	def plug_search(self, list, key, value):
-		for item in list:
-			if item[key] == value:
-				return item
+	##~~ Utilities
 
 	def sendCommand(self, cmd, plugip):
-		# try to connect via ip address
+		if self._is_shared_client():
+			try:
+				return self._shared.request(cmd, plugip, SHARED_REQUEST_TIMEOUT)
+			except SharedRequestPending as e:
+				self._wemoswitch_logger.debug("Shared device owner is still running %s for %s: %s" % (cmd, plugip, e))
+				return 3
+			except DeviceUnreachable as e:
+				self._wemoswitch_logger.debug("Shared device owner didn't run %s for %s, talking to the plug directly: %s" % (cmd, plugip, e))
+		return self._device_command(cmd, plugip)
+
+	def _device_command(self, cmd, plugip):
+		# unreachable plugs fail fast instead of stalling status sweeps, but a power off is
+		# always attempted since thermal runaway and idle shutdown depend on it
+		health = self._health(plugip)
+		if not health.allow() and cmd != "off":
+			self._wemoswitch_logger.debug("Skipping %s for %s, unreachable for another %.0fs." % (cmd, plugip, health.retry_in()))
+			return 3
+
+		# connecting, probing and every SOAP request are bounded by the device timeouts
+		try:
+			result = self._send_command(cmd, plugip)
+		except Exception as e:
+			self._wemoswitch_logger.debug("Could not connect to %s: %r" % (plugip, e))
+			self._invalidate_device(plugip)
+			if health.record_failure(repr(e)):
+				self._wemoswitch_logger.debug("Marking %s unreachable for %ss after %s consecutive failures." % (plugip, health.backoff, health.failures))
+			return 3
+
+		health.record_success()
+		return result
+
+	def _send_command(self, cmd, plugip):
+		device = self._get_device(plugip)
+		if device is None:
+			raise DeviceUnreachable("Could not connect to %s" % plugip)
+
+		self._wemoswitch_logger.debug("Sending command %s to %s" % (cmd, plugip))
+
+		if cmd == "info":
+			with self._metrics.timed(plugip, "get_state"):
+				state = device.get_state(force_update=True)
+			self._sample_power(plugip, device)
+			return state
+		elif cmd == "on":
+			with self._metrics.timed(plugip, "on"):
+				device.on()
+			self._sample_power(plugip, device)
+			return 0
+		elif cmd == "off":
+			with self._metrics.timed(plugip, "off"):
+				device.off()
+			self._sample_power(plugip, device)
+			return 0
+
+	##~~ Power History
+
+	def _sample_power(self, plugip, device):
+		# Insight plugs refresh these with every state read or switch, no extra request needed
+		params = getattr(device, "insight_params", None)
+		if params and self._config.powerHistoryEnabled:
+			self._record_power(plugip, params)
+
+	def _on_insight_event(self, plugip, device, event_type, value):
+		if not self._config.powerHistoryEnabled:
+			return
+		try:
+			params = device.parse_insight_params(value)
+		except (ValueError, OverflowError, OSError):
+			self._wemoswitch_logger.debug("Invalid %s event %s from %s." % (event_type, value, plugip))
+			return
+		self._record_power(plugip, params)
+
+	def _record_power(self, plugip, params):
+		now = time.time()
+		watts = params["currentpower"] / 1000.0
+		# energy is reported in milliwatt minutes
+		latest = dict(time=now, watts=watts, today_kwh=params["todaymw"] / 6e7, total_kwh=params["totalmw"] / 6e7,
+					  on_for=params["onfor"])
+		with self._power_history_lock:
+			history = self._power_histories.get(plugip)
+			if history is None:
+				history = self._power_histories[plugip] = PowerHistory()
+		history.add(now, watts, latest)
+		self._plugin_manager.send_plugin_message(self._identifier, dict(type="power", plugs={plugip: dict(latest=latest, points=[[now, watts]])}))
+
+	def _power_overview(self):
+		with self._power_history_lock:
+			histories = dict(self._power_histories)
+		return dict((plugip, dict(latest=history.latest, points=history.recent(POWER_SPARKLINE_POINTS)))
+					for plugip, history in histories.items())
+
+	def _retain_power_histories(self, plugips):
+		with self._power_history_lock:
+			for plugip in list(self._power_histories.keys()):
+				if plugip not in plugips:
+					del self._power_histories[plugip]
+
+	##~~ Plug Health
+
+	def _health(self, plugip):
+		with self._plug_health_lock:
+			health = self._plug_health.get(plugip)
+			if health is None:
+				health = self._plug_health[plugip] = PlugHealth()
+			return health
+
+	def _reset_health(self):
+		with self._plug_health_lock:
+			self._plug_health.clear()
+
+	def _health_stats(self):
+		with self._plug_health_lock:
+			health = dict(self._plug_health)
+		return dict((plugip, h.stats()) for plugip, h in health.items())
+
+	##~~ Device Cache
+
+	def _get_device(self, plugip):
+		with self._device_cache_lock:
+			entry = self._device_cache.get(plugip)
+		if entry is not None:
+			return entry["device"]
+
+		entry = self._resolve_device(plugip)
+		if entry is None:
+			return None
+
+		with self._device_cache_lock:
+			last_serial = self._device_serials.get(plugip)
+			if last_serial is not None and last_serial != entry["serial"]:
+				self._wemoswitch_logger.debug("Serial for %s changed from %s to %s." % (plugip, last_serial, entry["serial"]))
+			self._device_serials[plugip] = entry["serial"]
+			self._device_cache[plugip] = entry
+		self._subscribe_plug(plugip, entry["device"])
+		return entry["device"]
+
+	def _resolve_device(self, plugip):
+		pywemo = load_pywemo()
+		host = plugip
 		port = None
 		try:
-			if ':' in plugip:
-				plugip, port = plugip.split(':', 1)
+			if ':' in host:
+				host, port = host.split(':', 1)
 				port = int(port)
-			socket.inet_aton(plugip)
-			self._wemoswitch_logger.debug("IP %s is valid." % plugip)
-		except socket.error or ValueError:
-			# try to convert hostname to ip
-			self._wemoswitch_logger.debug("Invalid ip %s trying hostname." % plugip)
-			try:
-				plugip = socket.gethostbyname(plugip)
-				self._wemoswitch_logger.debug("Hostname %s is valid." % plugip)
-			except (socket.herror, socket.gaierror):
-				self._wemoswitch_logger.debug("Invalid hostname %s." % plugip)
-				return 3
+		except ValueError:
+			self._wemoswitch_logger.debug("Invalid port in %s." % plugip)
+			return None
+
+		# hostnames are looked up through the resolver cache
+		address = self._resolver.resolve(host)
+		if address is None:
+			self._wemoswitch_logger.debug("Invalid hostname %s." % host)
+			return None
+		if address != host:
+			self._wemoswitch_logger.debug("Hostname %s is %s." % (host, address))
+		host = address
 
 		try:
-			self._wemoswitch_logger.debug("Attempting to connect to %s" % plugip)
+			self._wemoswitch_logger.debug("Attempting to connect to %s" % host)
 			if port is None:
-				port = pywemo.ouimeaux_device.probe_wemo(plugip)
-			url = 'http://%s:%s/setup.xml' % (plugip, port)
+				start = monotonic_time()
+				port = pywemo.ouimeaux_device.probe_wemo(host, probe_timeout=(DEVICE_CONNECT_TIMEOUT, DEVICE_READ_TIMEOUT))
+				self._metrics.observe(plugip, "probe", monotonic_time() - start, error=port is None)
+			url = 'http://%s:%s/setup.xml' % (host, port)
 			url = url.replace(':None', '')
 			self._wemoswitch_logger.debug("Getting device info from %s" % url)
+			start = monotonic_time()
 			device = pywemo.discovery.device_from_description(url)
+			self._metrics.observe(plugip, "setup_xml", monotonic_time() - start, error=device is None)
+		except (socket.error, pywemo.PyWeMoException):
+			self._wemoswitch_logger.debug("Could not connect to %s." % host)
+			return None
 
-			self._wemoswitch_logger.debug("Found device %s" % device)
-			self._wemoswitch_logger.debug("Sending command %s to %s" % (cmd, plugip))
-
-			if cmd == "info":
-				return device.get_state()
-			elif cmd == "on":
-				device.on()
-				return 0
-			elif cmd == "off":
-				device.off()
-				return 0
+		if device is None:
+			self._wemoswitch_logger.debug("Could not get device info from %s." % host)
+			return None
 
-		except socket.error:
-			self._wemoswitch_logger.debug("Could not connect to %s." % plugip)
-			return 3
+		# all further traffic to the plug goes through its shared keep-alive pool
+		device.session = PooledSession(device.session, self._device_pools)
+		# a failed call invalidates this handle and the next one resolves the plug again, pywemo's own
+		# retries would re-probe and rescan the network for every failed action first
+		device.reconnect_with_device = lambda: None
+		for service in device.services.values():
+			for action in service.actions.values():
+				action.max_rediscovery_attempts = 1
+
+		self._wemoswitch_logger.debug("Found device %s" % device)
+		return {"host": host, "port": device.port, "serial": device.serial_number, "device": device}
+
+	def _invalidate_device(self, plugip=None):
+		with self._device_cache_lock:
+			if plugip is None:
+				self._device_cache.clear()
+				entry = None
+			else:
+				entry = self._device_cache.pop(plugip, None)
+		# don't hand sockets to a plug that just failed to the next attempt
+		if plugip is None:
+			self._device_pools.close()
+		elif entry is not None:
+			self._device_pools.close(entry["host"], entry["port"])
+
+	def _check_device_serial(self, host, port, serial):
+		# drop cached handles that now point at a different device, i.e. after a DHCP reshuffle
+		with self._device_cache_lock:
+			for plugip, entry in list(self._device_cache.items()):
+				if entry["host"] == host and entry["port"] == port and entry["serial"] != serial:
+					self._wemoswitch_logger.debug("Device at %s:%s is now %s, dropping cached %s." % (host, port, serial, entry["serial"]))
+					del self._device_cache[plugip]
 
 	##~~ Access Permissions Hook
 
@@ -617,77 +2577,96 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 	##~~ Gcode processing hook
 
 	def gcode_turn_off(self, plug):
-		if plug["warnPrinting"] and self._printer.is_printing():
-			self._logger.info("Not powering off %s because printer is printing." % plug["label"])
+		if plug.warnPrinting and self._printer.is_printing():
+			self._logger.info("Not powering off %s because printer is printing." % plug.label)
 		else:
-			self.turn_off(plug["ip"])
+			self.turn_off(plug.ip)
 
 	def processAtCommand(self, comm_instance, phase, command, parameters, tags=None, *args, **kwargs):
 		if command in ["WEMOON", "WEMOOFF"]:
 			plugip = parameters.strip()
 			self._wemoswitch_logger.debug("Received %s command, attempting power on of %s." % (command, plugip))
-			plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
+			plug = self._plugs.get(plugip)
 			self._wemoswitch_logger.debug(plug)
 		else:
 			return None
+		if plug is None or not plug.gcodeEnabled:
+			return None
 		if command == "WEMOON":
-			if plug["gcodeEnabled"]:
-				t = threading.Timer(int(plug["gcodeOnDelay"]), self.turn_on, args=[plugip])
-				t.start()
+			self._scheduler.schedule(plug.gcodeOnDelay, self.turn_on, args=[plugip], offload=True)
 			return None
 		if command == "WEMOOFF":
-			if plug["gcodeEnabled"]:
-				t = threading.Timer(int(plug["gcodeOffDelay"]), self.gcode_turn_off, args=[plug])
-				t.start()
+			self._scheduler.schedule(plug.gcodeOffDelay, self.gcode_turn_off, args=[plug], offload=True)
 			return None
 
 	def processGCODE(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-		if self.powerOffWhenIdle and not (gcode in self._idleIgnoreCommandsArray):
+		# runs for every queued line, keep it to a set lookup, a timestamp and a dict lookup (target < 1µs per line)
+		config = self._config
+		if config.powerOffWhenIdle and gcode not in config.idleIgnoreCommands:
 			self._waitForHeaters = False
-			self._reset_idle_timer()
-		if gcode:
-			if cmd.startswith("M80"):
-				plugip = re.sub(r'^M80\s?', '', cmd)
-				self._wemoswitch_logger.debug("Received M80 command, attempting power on of %s." % plugip)
-				plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-				self._wemoswitch_logger.debug(plug)
-				if plug["gcodeEnabled"]:
-					t = threading.Timer(int(plug["gcodeOnDelay"]), self.turn_on, args=[plugip])
-					t.start()
-				return
-			elif cmd.startswith("M81"):
-				plugip = re.sub(r'^M81\s?', '', cmd)
-				self._wemoswitch_logger.debug("Received M81 command, attempting power off of %s." % plugip)
-				plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-				self._wemoswitch_logger.debug(plug)
-				if plug["gcodeEnabled"]:
-					t = threading.Timer(int(plug["gcodeOffDelay"]), self.gcode_turn_off, [plug])
-					t.start()
-				return
-			else:
-				return
+			self._last_activity = monotonic_time()
+		handler = self._gcode_handlers.get(gcode)
+		if handler is not None:
+			handler(cmd)
+
+	def _gcode_power_on(self, cmd):
+		plugip = cmd[3:].strip()
+		self._wemoswitch_logger.debug("Received M80 command, attempting power on of %s." % plugip)
+		plug = self._plugs.get(plugip)
+		self._wemoswitch_logger.debug(plug)
+		if plug is not None and plug.gcodeEnabled:
+			self._scheduler.schedule(plug.gcodeOnDelay, self.turn_on, args=[plugip], offload=True)
+
+	def _gcode_power_off(self, cmd):
+		plugip = cmd[3:].strip()
+		self._wemoswitch_logger.debug("Received M81 command, attempting power off of %s." % plugip)
+		plug = self._plugs.get(plugip)
+		self._wemoswitch_logger.debug(plug)
+		if plug is not None and plug.gcodeEnabled:
+			self._scheduler.schedule(plug.gcodeOffDelay, self.gcode_turn_off, args=[plug], offload=True)
+
+	def _build_plug_registry(self):
+		self._plugs = WemoPlugRegistry(self._config.plugs)
+		self._resolver.prefetch(set(plugip.split(":", 1)[0] for plugip in self._plugs.ips))
 
 	def check_temps(self, parsed_temps):
+		config = self._config
 		thermal_runaway_triggered = False
 		for k, v in parsed_temps.items():
-			if k == "B" and v[1] > 0 and v[0] > int(self._settings.get(["thermal_runaway_max_bed"])):
+			actual, target = v[0], v[1]
+			if actual is None or not target:
+				continue
+			if k == "B" and actual > config.thermal_runaway_max_bed:
 				self._wemoswitch_logger.debug("Max bed temp reached, shutting off plugs.")
 				thermal_runaway_triggered = True
-			if k.startswith("T") and v[1] > 0 and v[0] > int(self._settings.get(["thermal_runaway_max_extruder"])):
+			if k.startswith("T") and actual > config.thermal_runaway_max_extruder:
 				self._wemoswitch_logger.debug("Extruder max temp reached, shutting off plugs.")
 				thermal_runaway_triggered = True
-			if thermal_runaway_triggered == True:
-				for plug in self._settings.get(['arrSmartplugs']):
-					if plug["thermal_runaway"] == True:
-						response = self.turn_off(plug["ip"])
-						if response["currentState"] == "off":
-							self._plugin_manager.send_plugin_message(self._identifier, response)
+
+		if not thermal_runaway_triggered:
+			# re-arm once temperatures are back in range
+			self._thermal_runaway_tripped = False
+			return
+
+		if self._thermal_runaway_tripped:
+			return
+		self._thermal_runaway_tripped = True
+
+		results = self._group_command(self._turn_off_and_wait, self._plugs.thermal_runaway_plugs, "thermal runaway",
+									  fan_out=self._safety_fan_out)
+		failed = [plugip for plugip, outcome in results.items()
+				  if outcome["result"] is None or outcome["result"]["status"] != "done"]
+		if failed:
+			# stay armed so the next temperature report tries again
+			self._wemoswitch_logger.debug("Thermal runaway power off failed for %s, retrying on the next report." % ", ".join(failed))
+			self._thermal_runaway_tripped = False
 
 	def monitor_temperatures(self, comm, parsed_temps):
-		if self._settings.get(["thermal_runaway_monitoring"]):
-			# Run inside it's own thread to prevent communication blocking
-			t = threading.Timer(0, self.check_temps, [parsed_temps])
-			t.start()
+		if self._config.thermal_runaway_monitoring:
+			# checked on the monitor thread to prevent communication blocking, only the latest report is kept
+			self._thermal_monitor.put(parsed_temps)
+		if self._cooldown_pending:
+			self._check_cooldown(self._parsed_tool_temps(parsed_temps))
 		return parsed_temps
 
 	##~~ Softwareupdate hook
@@ -721,7 +2700,7 @@ class wemoswitchPlugin(octoprint.plugin.SettingsPlugin,
 
 
 __plugin_name__ = "Wemo Switch"
-__plugin_pythoncompat__ = ">=2.7,<4"
+__plugin_pythoncompat__ = ">=3,<4"
 
 
 def __plugin_load__():
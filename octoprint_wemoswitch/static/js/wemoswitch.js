@@ -15,15 +15,23 @@ $(function() {
 		self.isPrinting = ko.observable(false);
 		self.selectedPlug = ko.observable();
 		self.discovered_devices = ko.observableArray([]);
-		self.discovering_devices = ko.observableArray([]);
+		self.discovering_devices = ko.observable(false);
 		self.selected_discovered_device = ko.observable();
 		self.processing = ko.observableArray([]);
 		self.powerOffWhenIdle = ko.observable(false);
+		self.plugStates = {};
+		self.powerPlugs = ko.observableArray([]);
+		self.sparklineLength = 60;
 		self.show_sidebar = ko.pureComputed(function(){
 		    var filtered = ko.utils.arrayFilter(self.settings.settings.plugins.wemoswitch.arrSmartplugs(), function(item) {
                 return item["automaticShutdownEnabled"];
             });
-			return filtered.length > 0;
+			return filtered.length > 0 || self.powerPlugs().length > 0;
+		});
+
+		// the sidebar body only holds the power sparklines
+		self.powerPlugs.subscribe(function(plugs) {
+			$("#sidebar_plugin_wemoswitch").toggle(plugs.length > 0);
 		});
 
 		self.toggleShutdownTitle = ko.pureComputed(function() {
@@ -91,8 +99,7 @@ $(function() {
 		}
 
 		self.abortShutdown = function(abortShutdownValue) {
-			self.timeoutPopup.remove();
-			self.timeoutPopup = undefined;
+			self.stopCountdown();
 			$.ajax({
 				url: API_BASEURL + "plugin/wemoswitch",
 				type: "POST",
@@ -104,25 +111,113 @@ $(function() {
 			})
 		}
 
+		// the server only sends what's left, the countdown itself runs here. It counts from when
+		// the message arrived so a browser clock that's off from the server's can't shorten it
+		self.startCountdown = function(timeoutValue) {
+			self.countdownDeadline = Date.now() + timeoutValue * 1000;
+			if (typeof self.countdownTimer == "undefined") {
+				self.countdownTimer = setInterval(self.updateCountdown, 250);
+			}
+			self.updateCountdown();
+		}
+
+		self.updateCountdown = function() {
+			var remaining = Math.ceil((self.countdownDeadline - Date.now()) / 1000);
+			if (remaining <= 0) {
+				self.stopCountdown();
+				return;
+			}
+			self.timeoutPopupOptions.text = self.timeoutPopupText + remaining;
+			if (typeof self.timeoutPopup != "undefined") {
+				self.timeoutPopup.update(self.timeoutPopupOptions);
+			} else {
+				self.timeoutPopup = new PNotify(self.timeoutPopupOptions);
+				self.timeoutPopup.get().on('pnotify.cancel', function() {self.abortShutdown(true);});
+			}
+		}
+
+		self.stopCountdown = function() {
+			if (typeof self.countdownTimer != "undefined") {
+				clearInterval(self.countdownTimer);
+				self.countdownTimer = undefined;
+			}
+			if (typeof self.timeoutPopup != "undefined") {
+				self.timeoutPopup.remove();
+				self.timeoutPopup = undefined;
+			}
+		}
+
 		self.onBeforeBinding = function() {
 			self.arrSmartplugs(self.settings.settings.plugins.wemoswitch.arrSmartplugs());
         }
 
 		self.onAfterBinding = function() {
-			self.checkStatuses();
+			// states pushed by the server before binding completed
+			for (var ip in self.plugStates) {
+				self.updatePlugState(ip, self.plugStates[ip]);
+			}
+		}
+
+		// the plug editor's dependencies aren't part of every page, they are fetched once settings are opened
+		self.editorAssets = undefined;
+		self.loadEditorAssets = function() {
+			if (typeof self.editorAssets == "undefined") {
+				var base = BASEURL + "plugin/wemoswitch/static/";
+				$("<link/>", {rel: "stylesheet", type: "text/css", href: base + "css/fontawesome-iconpicker.css"}).appendTo("head");
+
+				var scripts = [];
+				if (!($.ui && $.ui.sortable)) {
+					scripts.push("js/jquery-ui.min.js");
+				}
+				if (!ko.bindingHandlers.sortable) {
+					scripts.push("js/knockout-sortable.1.2.0.js");
+				}
+				scripts.push("js/fontawesome-iconpicker.js", "js/ko.iconpicker.js");
+
+				// in order, each script builds on the ones before it
+				self.editorAssets = scripts.reduce(function(previous, script) {
+					return previous.then(function() {
+						return $.ajax({url: base + script, dataType: "script", cache: true});
+					});
+				}, $.Deferred().resolve().promise());
+				self.editorAssets.fail(function() {
+					self.editorAssets = undefined;
+				});
+			}
+			return self.editorAssets;
 		}
 
 		self.onSettingsShown = function() {
-            self.discovering_devices(true);
+			self.loadEditorAssets();
             console.log("wemoswitch plugin discovering devices");
+            // returns the cached list right away, anything found by a running scan arrives as plugin messages
             OctoPrint.simpleApiGet('wemoswitch', {data: {discover_devices:true}}).done(function(response){
                 self.discovered_devices(response["discovered_devices"]);
-                self.discovering_devices(false);
+                self.discovering_devices(response["discovering"]);
             });
         }
 
+		self.addDiscoveredDevice = function(device) {
+			var existing = ko.utils.arrayFirst(self.discovered_devices(), function(item) {
+				return item.ip === device.ip;
+			});
+			if (!existing) {
+				self.discovered_devices.push(device);
+			}
+		}
+
         self.onEventSettingsUpdated = function(payload) {
 			self.arrSmartplugs(self.settings.settings.plugins.wemoswitch.arrSmartplugs());
+			if (!self.settings.settings.plugins.wemoswitch.powerHistoryEnabled()) {
+				self.powerPlugs([]);
+				return;
+			}
+			var ips = ko.utils.arrayMap(self.arrSmartplugs(), function(item) {
+				return item.ip();
+			});
+			self.powerPlugs.remove(function(entry) {
+				return ips.indexOf(entry.ip) < 0;
+			});
 		}
 
 		self.onEventPrinterStateChanged = function(payload) {
@@ -138,9 +233,11 @@ $(function() {
 		}
 
 		self.editPlug = function(data) {
-		    self.selected_discovered_device(undefined);
-			self.selectedPlug(data);
-			$("#WemoSwitchEditor").modal("show");
+			self.loadEditorAssets().done(function() {
+				self.selected_discovered_device(undefined);
+				self.selectedPlug(data);
+				$("#WemoSwitchEditor").modal("show");
+			});
 		}
 
 		self.use_discovered = function(data) {
@@ -151,33 +248,37 @@ $(function() {
         }
 
 		self.addPlug = function() {
-			self.selectedPlug({'ip':ko.observable(''),
-                                'label':ko.observable(''),
-                                'icon':ko.observable('icon-bolt'),
-                                'displayWarning':ko.observable(true),
-                                'warnPrinting':ko.observable(false),
-                                'thermal_runaway':ko.observable(false),
-                                'gcodeEnabled':ko.observable(false),
-                                'gcodeOnDelay':ko.observable(0),
-                                'gcodeOffDelay':ko.observable(0),
-                                'autoConnect':ko.observable(true),
-                                'autoConnectDelay':ko.observable(10.0),
-                                'autoDisconnect':ko.observable(true),
-                                'autoDisconnectDelay':ko.observable(0),
-                                'sysCmdOn':ko.observable(false),
-                                'sysRunCmdOn':ko.observable(''),
-                                'sysCmdOnDelay':ko.observable(0),
-                                'sysCmdOff':ko.observable(false),
-                                'sysRunCmdOff':ko.observable(''),
-                                'sysCmdOffDelay':ko.observable(0),
-                                'currentState':ko.observable('unknown'),
-                                'btnColor':ko.observable('#808080'),
-                                'automaticShutdownEnabled':ko.observable(false),
-                                'event_on_startup':ko.observable(false),
-                                'event_on_upload':ko.observable(false)});
-			self.settings.settings.plugins.wemoswitch.arrSmartplugs.push(self.selectedPlug());
-			self.selected_discovered_device(undefined);
-			$("#WemoSwitchEditor").modal("show");
+			self.loadEditorAssets().done(function() {
+				self.selectedPlug({'ip':ko.observable(''),
+                                    'label':ko.observable(''),
+                                    'icon':ko.observable('icon-bolt'),
+                                    'displayWarning':ko.observable(true),
+                                    'warnPrinting':ko.observable(false),
+                                    'thermal_runaway':ko.observable(false),
+                                    'gcodeEnabled':ko.observable(false),
+                                    'gcodeOnDelay':ko.observable(0),
+                                    'gcodeOffDelay':ko.observable(0),
+                                    'autoConnect':ko.observable(true),
+                                    'autoConnectDelay':ko.observable(10.0),
+                                    'autoDisconnect':ko.observable(true),
+                                    'autoDisconnectDelay':ko.observable(0),
+                                    'sysCmdOn':ko.observable(false),
+                                    'sysRunCmdOn':ko.observable(''),
+                                    'sysCmdOnDelay':ko.observable(0),
+                                    'sysCmdOnTimeout':ko.observable(0),
+                                    'sysCmdOff':ko.observable(false),
+                                    'sysRunCmdOff':ko.observable(''),
+                                    'sysCmdOffDelay':ko.observable(0),
+                                    'sysCmdOffTimeout':ko.observable(0),
+                                    'currentState':ko.observable('unknown'),
+                                    'btnColor':ko.observable('#808080'),
+                                    'automaticShutdownEnabled':ko.observable(false),
+                                    'event_on_startup':ko.observable(false),
+                                    'event_on_upload':ko.observable(false)});
+				self.settings.settings.plugins.wemoswitch.arrSmartplugs.push(self.selectedPlug());
+				self.selected_discovered_device(undefined);
+				$("#WemoSwitchEditor").modal("show");
+			});
 		}
 
 		self.removePlug = function(row) {
@@ -192,30 +293,56 @@ $(function() {
 			if(data.hasOwnProperty("powerOffWhenIdle")) {
 			    if (data.type == "timeout") {
 					if ((data.timeout_value != null) && (data.timeout_value > 0)) {
-						self.timeoutPopupOptions.text = self.timeoutPopupText + data.timeout_value;
-						if (typeof self.timeoutPopup != "undefined") {
-							self.timeoutPopup.update(self.timeoutPopupOptions);
-						} else {
-							self.timeoutPopup = new PNotify(self.timeoutPopupOptions);
-							self.timeoutPopup.get().on('pnotify.cancel', function() {self.abortShutdown(true);});
-						}
+						self.startCountdown(data.timeout_value);
 					} else {
-						if (typeof self.timeoutPopup != "undefined") {
-							self.timeoutPopup.remove();
-							self.timeoutPopup = undefined;
-						}
+						self.stopCountdown();
 					}
 				}
 				return;
 			}
 
-			plug = ko.utils.arrayFirst(self.settings.settings.plugins.wemoswitch.arrSmartplugs(),function(item){
-				return item.ip() === data.ip;
-				}) || {'ip':data.ip,'currentState':'unknown','btnColor':'#808080'};
+			if (data.type == "discovery") {
+				if (data.hasOwnProperty("device")) {
+					self.addDiscoveredDevice(data.device);
+				}
+				if (data.hasOwnProperty("discovered_devices")) {
+					self.discovered_devices(data.discovered_devices);
+				}
+				self.discovering_devices(data.discovering);
+				return;
+			}
+
+			if (data.type == "power_off") {
+				self.updatePlugState(data.ip, data.currentState);
+				self.processing.remove(data.ip);
+				return;
+			}
+
+			if (data.type == "states") {
+				for (var ip in data.states) {
+					self.updatePlugState(ip, data.states[ip]);
+				}
+				return;
+			}
 
-			if (plug.currentState !== data.currentState) {
-				plug.currentState(data.currentState)
-				switch(data.currentState) {
+			if (data.type == "power") {
+				self.updatePower(data.plugs);
+				return;
+			}
+
+			self.updatePlugState(data.ip, data.currentState);
+			self.processing.remove(data.ip);
+        };
+
+		self.updatePlugState = function(ip, currentState) {
+			self.plugStates[ip] = currentState;
+			var plug = ko.utils.arrayFirst(self.settings.settings.plugins.wemoswitch.arrSmartplugs(),function(item){
+				return item.ip() === ip;
+				});
+
+			if (plug && plug.currentState() !== currentState) {
+				plug.currentState(currentState)
+				switch(currentState) {
 					case "on":
 						break;
 					case "off":
@@ -230,8 +357,60 @@ $(function() {
 				self.settings.saveData();
 				}
 			}
-			self.processing.remove(data.ip);
-        };
+		};
+
+		self.updatePower = function(plugs) {
+			for (var ip in plugs) {
+				var entry = ko.utils.arrayFirst(self.powerPlugs(), function(item) {
+					return item.ip === ip;
+				});
+				if (!entry) {
+					entry = self.createPowerEntry(ip);
+					self.powerPlugs.push(entry);
+				}
+				entry.latest(plugs[ip].latest);
+				entry.points(entry.points().concat(plugs[ip].points).slice(-self.sparklineLength));
+			}
+		};
+
+		self.createPowerEntry = function(ip) {
+			var entry = {ip: ip, latest: ko.observable(), points: ko.observableArray([])};
+			entry.label = ko.pureComputed(function() {
+				var plug = ko.utils.arrayFirst(self.settings.settings.plugins.wemoswitch.arrSmartplugs(), function(item) {
+					return item.ip() === ip;
+				});
+				return plug && plug.label() ? plug.label() : ip;
+			});
+			entry.sparkline = ko.pureComputed(function() {
+				return self.sparklinePoints(entry.points());
+			});
+			return entry;
+		};
+
+		// polyline points in a 100x20 box, time along x and watts scaled to the highest reading
+		self.sparklinePoints = function(points) {
+			if (points.length < 2) {
+				return "";
+			}
+			var first = points[0][0];
+			var span = (points[points.length - 1][0] - first) || 1;
+			var max = Math.max.apply(null, points.map(function(point) { return point[1]; })) || 1;
+			return points.map(function(point) {
+				return ((point[0] - first) / span * 100).toFixed(1) + "," + (20 - point[1] / max * 20).toFixed(1);
+			}).join(" ");
+		};
+
+		self.formatWatts = function(latest) {
+			return latest ? latest.watts.toFixed(1) + " W" : "";
+		};
+
+		self.powerTitle = function(entry) {
+			var latest = entry.latest();
+			if (!latest) {
+				return "";
+			}
+			return "Today " + latest.today_kwh.toFixed(2) + " kWh, total " + latest.total_kwh.toFixed(2) + " kWh";
+		};
 
 		self.toggleRelay = function(data) {
 			self.processing.push(data.ip());
@@ -295,6 +474,7 @@ $(function() {
 				});
         };
 
+		// polling happens server side, this is only the manual refresh from the sidebar
 		self.checkStatuses = function() {
 			ko.utils.arrayForEach(self.settings.settings.plugins.wemoswitch.arrSmartplugs(),function(item){
 				if(item.ip() !== "") {
@@ -302,9 +482,6 @@ $(function() {
 					self.checkStatus(item.ip());
 				}
 			});
-			if (self.settings.settings.plugins.wemoswitch.pollingEnabled()) {
-				setTimeout(function() {self.checkStatuses();}, (parseInt(self.settings.settings.plugins.wemoswitch.pollingInterval(),10) * 60000));
-			};
         };
     }
 